@@ -0,0 +1,153 @@
+""" Benchmarks the bus search and the demand solve on seeded synthetic recipe graphs. """
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+import networkx as nx
+import numpy as np
+
+import bus
+import depdata
+
+# Synthetic Recipes
+def synthetic_recipes(items=100, depth=5, fan_in=3, goals=4, seed=0):
+    """ A seeded layered recipe DAG of about {items} items: a layer of raw resources, then {depth} layers of items each made from up to {fan_in} items of earlier layers, at least one from the layer just before. Returns the graph and the goals, drawn from the last layer. """
+    rng = random.Random(seed)
+    width = max(items//(depth+1), fan_in, goals)
+    layers = [["Item {}".format(i) for i in range(width)]]
+    G = nx.DiGraph()
+    G.add_nodes_from(layers[0])
+    for l in range(depth):
+        layer = ["Item {}".format(width*(l+1)+i) for i in range(width)]
+        earlier = [n for prev in layers for n in prev]
+        for n in layer:
+            ingredients, k = {rng.choice(layers[-1])}, min(rng.randint(1, fan_in), len(earlier))
+            while len(ingredients) < k:
+                ingredients.add(rng.choice(earlier))
+            G.add_node(n, Time=rng.choice([0.5, 1., 2., 5.]), QuantityOut=rng.randint(1, 2))
+            for c in ingredients:
+                G.add_edge(c, n, QuantityPer=float(rng.randint(1, 5)))
+        layers.append(layer)
+    return G, frozenset(rng.sample(layers[-1], goals))
+
+# Timers
+def timed(f, repeat=1):
+    """ Best wall time of {repeat} calls to {f}. """
+    best = float("inf")
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter()-t)
+    return best
+
+def bench_search(G0, B0, max_expansions, time_limit, max_states=None):
+    """ Runs one best first search, holding at most about {max_states} busses if given, timing the first and best solutions and the time spent trimming paths. """
+    GT = bus.init_search(G0, B0, bitmask=True, max_states=max_states)
+    start = time.perf_counter()
+    def out_of_budget():
+        return GT.graph["stats"].expansions >= max_expansions or time.perf_counter()-start >= time_limit
+    
+    first, best, best_rank, trim_time, paths = None, None, None, 0., 0
+    for h, path in bus.find_paths(GT, stop=out_of_budget):
+        t = time.perf_counter()
+        r = bus.rank(bus.trim_path(path, G0))
+        trim_time += time.perf_counter()-t
+        paths += 1
+        if best_rank is None or r < best_rank:
+            best_rank, best = r, time.perf_counter()-start
+            first = best if first is None else first
+        if out_of_budget():
+            break
+    elapsed = time.perf_counter()-start
+    
+    stats = GT.graph["stats"]
+    return {"expansions": stats.expansions,
+            "expansions_per_second": stats.expansions/elapsed,
+            "states": len(GT),
+            "paths": paths,
+            "seconds": elapsed,
+            "first_solution_seconds": first,
+            "best_solution_seconds": best,
+            "best_rank": [float(x) for x in best_rank] if best_rank else None,
+            "trim_path_seconds": trim_time,
+            "stats": stats.as_dict()}
+
+def peak_memory(f):
+    """ Peak memory in bytes allocated by Python while running {f}. """
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_size(items, depth, fan_in, goals, seed=0, max_expansions=2000, time_limit=10., repeat=5, max_states=None):
+    """ All timings for one synthetic recipe graph. """
+    G, G0 = synthetic_recipes(items, depth, fan_in, goals, seed)
+    old = bus.use_recipes(G)
+    try:
+        B0 = frozenset(bus.find_roots(G))
+        result = {"items": len(G), "recipes": G.number_of_edges(), "depth": depth, "fan_in": fan_in, "goals": goals, "seed": seed}
+        result["valid_seconds"] = timed(lambda: bus.valid(G0, B0), repeat)
+        result["possible_to_create_seconds"] = timed(lambda: bus.possible_to_create(B0), repeat)
+        result["search"] = bench_search(G0, B0, max_expansions, time_limit, max_states)
+        result["search_peak_bytes"] = peak_memory(lambda: bench_search(G0, B0, max_expansions, time_limit, max_states))
+        
+        # Demand for the goals
+        ids = {n: i for i, n in enumerate(G.nodes())}
+        edges = G.edges(data=True)
+        A = depdata.ingredient_matrix(len(ids), [ids[c] for c, p, d in edges], [ids[p] for c, p, d in edges], [d["QuantityPer"] for c, p, d in edges])
+        d = np.zeros(len(ids))
+        d[[ids[g] for g in G0]] = 1
+        result["solve_demand_seconds"] = timed(lambda: depdata.solve_demand(A, d), repeat)
+        return result
+    finally:
+        bus.use_recipes(old)
+
+def bench_depdata(repeat=5):
+    """ Times depdata.main on the shipped CSV, with its printing silenced. """
+    depdata.load_data()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return {"main_seconds": timed(lambda: depdata.main(save=False), repeat)}
+
+def version():
+    """ The git commit being benchmarked, if known. """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Default sizes as (items, depth, fan in, goals)
+sizes = [(50, 4, 3, 3), (200, 6, 3, 4), (1000, 8, 4, 6)]
+
+def main(sizes=sizes, seed=0, max_expansions=2000, time_limit=10., repeat=5, out=None, max_states=None):
+    results = {"version": version(), "python": platform.python_version(), "time": time.time(),
+               "max_expansions": max_expansions, "max_states": max_states, "depdata": bench_depdata(repeat), "sizes": []}
+    for items, depth, fan_in, goals in sizes:
+        r = bench_size(items, depth, fan_in, goals, seed, max_expansions, time_limit, repeat, max_states)
+        s = r["search"]
+        print("items {:5d} depth {:2d} fan in {} goals {}: {:8.0f} expansions/s, first {}, best {}, peak {:.1f} MB".format(
+            r["items"], depth, fan_in, goals, s["expansions_per_second"], s["first_solution_seconds"], s["best_solution_seconds"], r["search_peak_bytes"]/2.**20))
+        results["sizes"].append(r)
+    
+    if out:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--out", default="bench.json", help="Where to save the results as JSON.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-expansions", type=int, default=2000)
+    parser.add_argument("--time-limit", type=float, default=10.)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-states", type=int, default=None, help="Cap on the busses held by each search.")
+    args = parser.parse_args()
+    main(seed=args.seed, max_expansions=args.max_expansions, time_limit=args.time_limit, repeat=args.repeat, out=args.out, max_states=args.max_states)
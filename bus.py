@@ -1,17 +1,27 @@
 import pandas as pd
 import networkx as nx
 import numpy as np
+import heapq
+import time
+import itertools
+import multiprocessing as mp
+from functools import partial
+from collections import deque, OrderedDict
 from depdata import main as depdata
-from depdata import save_graph
+from depdata import save_graph, recipes, as_recipes, Recipes, Lazy
 
-# Get our dependency graph
-D = depdata(save=False)
+# Get our dependency graph as compact Recipes, built on first use
+D = Lazy(recipes)
 
 # Graph Tools
 def find_roots(ADG):
+    if isinstance(ADG, (Recipes, Lazy)):
+        return ADG.roots()
     return [n for n in ADG.nodes() if len(ADG.predecessors(n))==0]
     
 def find_heads(ADG):
+    if isinstance(ADG, (Recipes, Lazy)):
+        return ADG.heads()
     return [n for n in ADG.nodes() if len(ADG.successors(n))==0]
 
 def announce(f):
@@ -35,18 +45,18 @@ all_not_empty = lambda X: False if len(X) == 0 else all(X)
 def direct_supplied_by(g, Bi):
     """ Can the given goal node {g} be supplied by the given bus {Bi}? """
     assert isinstance(Bi, frozenset), "Bi {} should be a frozenset. Check your code that you are using sets instead of lists.".format(Bi)
-    return all_not_empty([p in Bi for p in D.predecessors_iter(g)])
+    return all_not_empty([p in Bi for p in D.predecessors(g)])
     
 def r_supplied_by(g, Bi):
     """ Can this node or all nodes which this goal node {g} is supplied by be supplied by the given bus {Bi}? """
-    if direct_supplied_by(g, Bi):
-        return True
-    else:
-        return all_not_empty([p in Bi or r_supplied_by(p, Bi) for p in D.predecessors_iter(g)])
+    I = bus_index()
+    return bool(I.supplied(I.encode(Bi, strict=False)) >> I.ids[g] & 1)
         
 def list_supplied_by(Gi, Bi):
     """ Checks if all items in a goal list {Gi} can be supplied by the given bus {Bi}. """
-    return all(r_supplied_by(g,Bi) for g in Gi)
+    I = bus_index()
+    supplied = I.supplied(I.encode(Bi, strict=False))
+    return all(supplied >> I.ids[g] & 1 for g in Gi)
 
 ## Create the main test methods
 def valid(G0, Bi):
@@ -111,32 +121,342 @@ def generate(Bi):
 """
 generate = creation_hypotheses # Gets rid of removal
 
+# Bitmask Encoding
+## Items are interned to integer ids so that a bus can be stored as a single int
+class BusIndex(object):
+    """ Interns the items of a recipe graph {ADG}, Recipes or NetworkX, to integer ids, so that each bus is an int bitmask and each recipe has a precomputed predecessor mask. """
+    def __init__(self, ADG, memo_size=100000, distance_memo_size=64):
+        # Ids follow a topological order, so iterating the bits of a mask visits ingredients before products
+        R = as_recipes(ADG)
+        order = R.order()
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        self.items = [R.items[i] for i in order]
+        self.ids = {n: i for i, n in enumerate(self.items)}
+        self.pred_mask = [sum(1 << int(rank[c]) for c in R.ingredients(i)[0]) for i in order]
+        self.succ_mask = [sum(1 << int(rank[p]) for p in R.products(i)) for i in order]
+        
+        # Reachability closure: every item made, directly or not, from each item
+        self.desc_mask = [0]*len(self.items)
+        for i in reversed(range(len(self.items))):
+            for s in iter_bits(self.succ_mask[i]):
+                self.desc_mask[i] |= (1 << s) | self.desc_mask[s]
+        
+        # Per-bus memo of the supplied items, and the distance tables of the last starting busses searched from
+        self.memo_size, self.distance_memo_size = memo_size, distance_memo_size
+        self.supplied_memo = {}
+        self.distance_memo = OrderedDict()
+
+    def encode(self, Bi, strict=True):
+        """ Converts a collection of item names {Bi} to a bitmask. If not {strict}, items not in the recipe graph are skipped. """
+        mask = 0
+        for b in Bi:
+            if strict or b in self.ids:
+                mask |= 1 << self.ids[b]
+        return mask
+
+    def decode(self, mask):
+        """ Converts a bitmask back to a frozenset of item names. """
+        return frozenset(self.items[i] for i in iter_bits(mask))
+
+    def direct_supplied_by(self, i, mask):
+        """ Mask version of direct_supplied_by for the item with id {i}. """
+        pred = self.pred_mask[i]
+        return pred != 0 and (pred & ~mask) == 0
+
+    def supplied(self, mask, parent=None):
+        """ Mask of every item the bus {mask} can eventually supply. If the {parent} bus is given, only the items made from the added items are rechecked. """
+        out = self.supplied_memo.get(mask)
+        if out is not None:
+            return out
+        
+        # Only items made from something on the bus can ever be supplied by it
+        if parent is not None and parent in self.supplied_memo:
+            out, added = self.supplied_memo[parent], mask & ~parent
+        else:
+            out, added = 0, mask
+        todo = 0
+        for b in iter_bits(added):
+            todo |= self.desc_mask[b]
+        
+        # Ids are topological, so every ingredient is decided before its product
+        for i in iter_bits(todo & ~out):
+            pred = self.pred_mask[i]
+            if pred and not pred & ~(mask | out):
+                out |= 1 << i
+        
+        if len(self.supplied_memo) >= self.memo_size:
+            self.supplied_memo.clear()
+        self.supplied_memo[mask] = out
+        return out
+
+    def r_supplied_by(self, i, mask):
+        """ Mask version of r_supplied_by for the item with id {i}. """
+        return bool(self.supplied(mask) >> i & 1)
+
+    def valid(self, goal_mask, mask, parent=None):
+        """ Mask version of valid. """
+        return mask != 0 and not goal_mask & ~self.supplied(mask, parent)
+
+    def test_b(self, goal_mask, mask):
+        """ Mask version of test_b. """
+        return (goal_mask & ~mask) == 0
+
+    def possible_to_create(self, mask):
+        """ Mask version of possible_to_create, returns a mask of the creatable items. """
+        successors = 0
+        for b in iter_bits(mask):
+            successors |= self.succ_mask[b]
+
+        out = 0
+        for s in iter_bits(successors & ~mask):
+            if self.direct_supplied_by(s, mask):
+                out |= 1 << s
+        return out
+
+    def creation_hypotheses(self, mask):
+        """ Mask version of creation_hypotheses. """
+        return set(mask | (1 << s) for s in iter_bits(self.possible_to_create(mask)))
+
+    def distances(self, mask, parent=None, table=None, start=False):
+        """ Table of the distance from the bus {mask} to every item, None where it can not be supplied. Given the {table} of a {parent} subset of the bus, only the items made from the added items are recomputed.
+            Tables of {start} busses are memoized for the next search from the same bus. """
+        if table is not None and not parent & ~mask:
+            out, todo = list(table), 0
+            for b in iter_bits(mask & ~parent):
+                todo |= (1 << b) | self.desc_mask[b]
+        elif start and mask in self.distance_memo:
+            self.distance_memo.move_to_end(mask)
+            return list(self.distance_memo[mask])
+        else:
+            out, todo = [None]*len(self.items), (1 << len(self.items)) - 1
+        
+        # One bottom-up pass, ids are topological
+        for i in iter_bits(todo):
+            if mask >> i & 1:
+                out[i] = 0
+                continue
+            pred = self.pred_mask[i]
+            d = [out[p] for p in iter_bits(pred)]
+            out[i] = 1+min(d) if pred and None not in d else None
+        
+        if start:
+            self.distance_memo[mask] = list(out)
+            while len(self.distance_memo) > self.distance_memo_size:
+                self.distance_memo.popitem(last=False)
+        return out
+
+def iter_bits(mask):
+    """ Yields the id of every set bit in {mask}, lowest first. """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def width(Bi):
+    """ Number of items on a bus, whether it is a frozenset or a bitmask. """
+    if isinstance(Bi, int):
+        return bin(Bi).count("1")
+    return len(Bi)
+
+_bus_index = None
+def bus_index():
+    """ The BusIndex of D, built on first use. """
+    global _bus_index
+    if _bus_index is None:
+        _bus_index = BusIndex(D)
+    return _bus_index
+
+def use_recipes(ADG):
+    """ Plans over the recipe graph {ADG}, Recipes or NetworkX, from now on, in place of D. Returns the previous graph. """
+    global D, _bus_index
+    old, D, _bus_index = D, ADG if isinstance(ADG, Lazy) else as_recipes(ADG), None
+    return old
+
+def as_items(GT, Bi):
+    """ The item names on the bus {Bi} of the search graph {GT}. """
+    I = GT.graph.get("index")
+    return I.decode(Bi) if I is not None else Bi
+
+def as_mask(GT, Bi):
+    """ The bitmask of the bus {Bi} of the search graph {GT}. """
+    if GT.graph.get("index") is not None:
+        return Bi
+    return bus_index().encode(Bi, strict=False)
+
+# Instrumentation
+class SearchStats(object):
+    """ Counters and per phase timings of one search. Every {every} expansions the number of live open busses is recorded and {callback}(stats) is called. """
+    phases = ("generate", "validate", "score", "select", "trim")
+    
+    def __init__(self, callback=None, every=100):
+        self.callback, self.every = callback, every
+        self.expansions = 0
+        self.hypotheses = 0
+        self.duplicates = 0
+        self.valid_calls = 0
+        self.score_calls = 0
+        self.paths = 0
+        self.same_trims = 0
+        self.evicted = 0
+        self.regressions = 0
+        self.seconds = dict.fromkeys(self.phases, 0.)
+        self.frontier = []
+        self.start = time.time()
+
+    def expanded(self, GT):
+        """ Counts one expansion of {GT}. """
+        self.expansions += 1
+        if self.expansions % self.every == 0:
+            self.frontier.append((self.expansions, time.time()-self.start, frontier_size(GT)))
+            if self.callback is not None:
+                self.callback(self)
+
+    def as_dict(self):
+        """ The stats as plain types, for logging. """
+        return {"expansions": self.expansions, "hypotheses": self.hypotheses, "duplicates": self.duplicates,
+                "valid_calls": self.valid_calls, "score_calls": self.score_calls, "paths": self.paths, "same_trims": self.same_trims, "evicted": self.evicted, "regressions": self.regressions,
+                "seconds": dict(self.seconds), "elapsed": time.time()-self.start, "frontier": list(self.frontier)}
+
+    def __repr__(self):
+        return "SearchStats({})".format(", ".join("{}={}".format(k, v) for k, v in self.as_dict().items() if k != "frontier"))
+
+def frontier_size(GT):
+    """ Live open busses of the searches of {GT}: the forward one, the backward one or both, as init_search made them. """
+    back = GT.graph.get("back")
+    size = back.graph["live"] if back is not None else 0
+    if back is None or back.graph["direction"] == "both":
+        size += GT.graph["live"]
+    return size
+
 # Graph
 def generate_and_validate(GT, G0, Bi):
+    stats = GT.graph["stats"]
     GT.node[Bi]['done'] = True
-    H = generate(Bi)
+    stats.expanded(GT)
+    
+    # Children are scored from the distance table of the bus being expanded, the only one held
+    GT.graph["expanding"] = Bi
+    
+    t = time.perf_counter()
+    I = GT.graph.get("index")
+    if I is not None:
+        goal_mask = GT.graph["goal mask"]
+        H = I.creation_hypotheses(Bi)
+    else:
+        H = generate(Bi)
+    
+    # Items outside the goals' ancestor cone never help
+    cone = GT.graph.get("cone")
+    if cone is not None:
+        mask = as_mask(GT, Bi)
+        H = [h for h in H if as_mask(GT, h) & ~mask & cone]
+    stats.hypotheses += len(H)
+    stats.seconds["generate"] += time.perf_counter()-t
+    
+    # A bounded search keeps a tree of first parents, which is all a path needs
+    bounded = GT.graph.get("max states") is not None
     for h in H:
-        if h not in GT:
-            v, t = valid(G0, h), test_b(G0, h)
-            GT.add_node(h, done=False, valid=v, test=t)
-            
-        GT.add_edge(Bi, h, added=h.difference(Bi), removed=Bi.difference(h))
-        if GT.node[h]["valid"]:
-            score(h, GT)
+        new = h not in GT
+        if new:
+            t = time.perf_counter()
+            if I is not None:
+                v, t_b = I.valid(goal_mask, h, parent=Bi), I.test_b(goal_mask, h)
+            else:
+                v, t_b = valid(G0, h), test_b(G0, h)
+            GT.add_node(h, done=False, valid=v, test=t_b)
+            stats.valid_calls += 1
+            stats.seconds["validate"] += time.perf_counter()-t
+        else:
+            stats.duplicates += 1
+            if bounded:
+                continue
+
+        if bounded:
+            GT.add_edge(Bi, h)
+        elif I is not None:
+            GT.add_edge(Bi, h, added=h & ~Bi, removed=Bi & ~h)
+        else:
+            GT.add_edge(Bi, h, added=h.difference(Bi), removed=Bi.difference(h))
+        
+        # Only new busses need a score, a bus reached again scores the same
+        if new and GT.node[h]["valid"]:
+            t = time.perf_counter()
+            GT.graph["score"](h, GT)
+            stats.score_calls += 1
+            add_to_frontier(GT, h)
+            stats.seconds["score"] += time.perf_counter()-t
+    
+    GT.graph["expanding"] = None
+    if bounded and len(GT) > GT.graph["max states"]:
+        evict(GT)
+
+# Frontier
+def init_frontier(GT):
+    """ Creates the open list and the queue of found goals on {GT}. The open list keeps stale entries until they are popped, "live" counts the busses on it which are not. """
+    GT.graph["open"] = []
+    GT.graph["live"] = 0
+    GT.graph["goals"] = deque()
+    GT.graph["counter"] = itertools.count()
+
+def add_to_frontier(GT, h):
+    """ Goal busses are queued for test, the rest are pushed on the open list by their score. """
+    if GT.node[h]["done"]:
+        return
+    if GT.node[h]["test"]:
+        GT.node[h]["done"] = True
+        GT.graph["goals"].append(h)
+    else:
+        # A bus pushed again after rescoring supersedes its old entry
+        if not GT.node[h].get("queued"):
+            GT.node[h]["queued"] = True
+            GT.graph["live"] += 1
+        heapq.heappush(GT.graph["open"], (GT.node[h]["score"], next(GT.graph["counter"]), h))
         
 def select_next(GT):
-    H = find_heads(GT)
-    scores = [GT.node[h]['score'] for h in H if not GT.node[h]['done']]
-    if scores:
-        best_score_idx = np.argmin(scores)
-        return H[best_score_idx]
+    """ Pops the best scored bus off the open list, lazily skipping busses which are done or have been rescored. """
+    open_list = GT.graph["open"]
+    while open_list:
+        s, _, h = heapq.heappop(open_list)
+        if not GT.node[h]["done"] and GT.node[h]["score"] == s:
+            GT.node[h]["queued"] = False
+            GT.graph["live"] -= 1
+            return h
+
+def evict(GT):
+    """ Brings {GT} a tenth under its cap on states. Dead ends, meaning invalid busses and expanded busses without children, are forgotten first, then the worst scored busses on the open list, rebuilding the open list without stale entries. The best tenth of the cap is always kept open so the search can go on. """
+    cap = GT.graph["max states"]
+    for n in [n for n in GT if GT.out_degree(n) == 0 and (GT.node[n]["done"] or not GT.node[n]["valid"])]:
+        if n in GT:
+            prune(GT, n)
+    
+    live = {}
+    for s, c, h in GT.graph["open"]:
+        if h in GT and not GT.node[h]["done"] and GT.node[h]["score"] == s:
+            live[h] = (s, c, h)
+    entries = sorted(live.values())
+    kept = max(len(entries) - (len(GT) - (cap - cap//10)), min(len(entries), cap//10 or 1))
+    for _, _, h in entries[kept:]:
+        prune(GT, h)
+    GT.graph["open"] = entries[:kept]
+    GT.graph["live"] = kept
+    heapq.heapify(GT.graph["open"])
+
+def prune(GT, h):
+    """ Removes {h} from {GT}, then each expanded parent left without children, as no path runs through them anymore. They are generated again if reached another way. """
+    stats, B0 = GT.graph["stats"], GT.graph["B0"]
+    while h != B0 and GT.out_degree(h) == 0 and not GT.node[h]["test"]:
+        parent = next(GT.predecessors_iter(h), None)
+        GT.remove_node(h)
+        stats.evicted += 1
+        if parent is None:
+            return
+        h = parent
 
 def test(GT):
-    H = find_heads(GT)
-    for i, h in enumerate(H):
-        if GT.node[h]["test"]:
-            GT.node[h]["done"] = True
-            return h
+    """ Returns the next goal bus found, if any. """
+    if GT.graph["goals"]:
+        return GT.graph["goals"].popleft()
 
 def needed_in(item, bus, exceptions={}):
     for b_item in bus:
@@ -145,28 +465,49 @@ def needed_in(item, bus, exceptions={}):
     return False
     
 def trim_path(path, G0):
-    outpath = []
+    """ Keeps only the items of each bus of {path} that are made into something on a later bus, the last bus being replaced by the goals {G0}. """
     G0 = frozenset(G0)
     path = list(path)
     
     assert valid(G0, path[0]), "Goal {} can not be supplied by the starting bus {}.".format(G0, path[0])
     assert all(g in path[-1] for g in G0), "Not all goals in the final element of path: {}".format([g for g in G0 if g not in path[-1]])
     
-    path[-1] = G0
-    
-    # An item is currunneeded if no future bus's needs include it
-    for i, b0 in enumerate(path[:-1]):
-        outbus = []
-        for item in b0:
-            for b1 in path[i+1:]:
-                if needed_in(item,b1,):
-                    #print("{} needed in {}".format(item, b1))
-                    outbus.append(item)
-                    break
-                #print("{} not needed in {}".format(item, b1))
-            #print("-----------------")
-        outpath.append(frozenset(outbus))
-    return outpath+[G0]
+    I = bus_index()
+    return [I.decode(m) for m in trim_masks(I, [I.encode(b, strict=False) for b in path[:-1]], I.encode(G0, strict=False))] + [G0]
+
+def trim_masks(I, masks, goal_mask):
+    """ Backward liveness sweep over the bus {masks} of a path ending in {goal_mask}: each bus keeps the items that are an ingredient of something on a later bus. The ingredients of later busses are gathered from the predecessor masks of {I}, each item once, so the sweep is linear in the size of the path. """
+    need, seen = 0, goal_mask
+    for g in iter_bits(goal_mask):
+        need |= I.pred_mask[g]
+    out = []
+    for mask in reversed(masks):
+        out.append(mask & need)
+        for i in iter_bits(mask & ~seen):
+            need |= I.pred_mask[i]
+        seen |= mask
+    out.reverse()
+    return out
+
+def trim_paths(paths, G0, stats=None):
+    """ Batch version of trim_path, yielding each distinct trimmed path of {paths} once, so paths that trim to the same result are only ranked once. Trimming is counted and timed in {stats}, if given. """
+    G0 = frozenset(G0)
+    I = bus_index()
+    goal_mask = I.encode(G0, strict=False)
+    seen = set()
+    for path in paths:
+        t = time.perf_counter()
+        assert all(g in path[-1] for g in G0), "Not all goals in the final element of path: {}".format([g for g in G0 if g not in path[-1]])
+        trimmed = tuple(trim_masks(I, [I.encode(b, strict=False) for b in path[:-1]], goal_mask))
+        new = trimmed not in seen
+        if new:
+            seen.add(trimmed)
+        if stats is not None:
+            stats.paths += 1
+            stats.same_trims += not new
+            stats.seconds["trim"] += time.perf_counter()-t
+        if new:
+            yield [I.decode(m) for m in trimmed] + [G0]
     
 # Distances
 def dist(GT, g, Bi):
@@ -175,90 +516,285 @@ def dist(GT, g, Bi):
     elif direct_supplied_by(g, Bi):
         return 1
     else:
-        return 1+min(dist(GT, p, Bi) for p in D.predecessors_iter(g))
+        return 1+min(dist(GT, p, Bi) for p in D.predecessors(g))
 
 # Scoring
+def distance_table(GT, Bi, tables=64):
+    """ The distance table of the bus {Bi}, kept for the last {tables} busses expanded. It is built from the table of a parent among them when there is one, else from scratch, or from the BusIndex memo for the starting bus. """
+    I, mask = bus_index(), as_mask(GT, Bi)
+    lru = GT.graph.setdefault("tables", OrderedDict())
+    if mask in lru:
+        lru.move_to_end(mask)
+        return lru[mask]
+    parent = next((p for p in map(partial(as_mask, GT), GT.predecessors_iter(Bi)) if p in lru), None) if Bi in GT else None
+    table = I.distances(mask, parent, lru[parent]) if parent is not None else I.distances(mask, start=Bi == GT.graph["B0"])
+    lru[mask] = table
+    while len(lru) > tables:
+        lru.popitem(last=False)
+    return table
+
 def score_by_distance(Bi, GT):
     assert Bi in GT, "{} not yet in GT".format(Bi)
-    total = 0
-    for g in G0:
-        d = dist(GT, g, Bi)
-        if d:
-            total += d
+    I, mask = bus_index(), as_mask(GT, Bi)
+    
+    # Children of the bus being expanded only recompute the items made from the added item, and keep no table
+    expanding = GT.graph.get("expanding")
+    if expanding is not None and not as_mask(GT, expanding) & ~mask:
+        table = I.distances(mask, as_mask(GT, expanding), distance_table(GT, expanding))
+    else:
+        table = distance_table(GT, Bi)
+    
+    total = sum(table[I.ids[g]] for g in GT.graph["G0"])
     GT.node[Bi]["score"] = total
     GT.node[Bi]["distance"] = total
     
 def score_with_min_length(Bi, GT, p=.5):
     assert Bi in GT, "{} not yet in GT".format(Bi)
-    B0 = GT.graph["B0"]
-    
-    if Bi is not B0:
-        all_paths = nx.all_simple_paths(GT, source=B0, target=Bi)
-        max_lengths = [max([len(b) for b in path]) for path in all_paths]
-        minimax = min(max_lengths)
-    else:
-        minimax = len(B0)
     
-    # Save Score
-    GT.node[Bi]["minimax length"] = minimax
+    # Busses only grow, so the widest bus of any path to {Bi} is {Bi} itself
     score_by_distance(Bi, GT)
     GT.node[Bi]["score"] *= (1.-p)
-    GT.node[Bi]["score"] += minimax*p
+    GT.node[Bi]["score"] += width(Bi)*p
 
 ## Default name for scoring
 score = score_by_distance
 
 # Main Process
-def main(G0, B0, max_n = 500, verbose=True):
-    # Throw an error if not possible from original bus
-    assert valid(G0, B0), "Goal {} can not be supplied by the starting bus {}.".format(G0, B0)
-    
-    # Generate generate and test graph
+def init_search(G0, B0, bitmask=False, scoring=None, stats=None, max_states=None, reduce=True, cone=False, direction="forward"):
+    """ Creates the generate and test graph, holding only the starting bus {B0}. Busses are scored with {scoring}, by default score, and the search is counted in {stats}, by default a new SearchStats.
+        With {max_states} set, the graph keeps only the first parent of each bus and evicts the worst scored open busses whenever it holds more than {max_states}, so only one path is found to each goal bus.
+        With {reduce}, find_paths skips paths that only differ from another by the order of additions which can not change their rank.
+        With {cone}, only the goals and their ingredients not on {B0} are ever added, which are the only items a best path adds.
+        {direction} "backward" regresses from the goals instead, and "both" runs both searches and joins them where they meet, see meet_paths. Both imply {cone} and {bitmask}. """
+    assert direction in ("forward", "backward", "both"), "Unknown direction {}.".format(direction)
+    if direction != "forward":
+        bitmask = cone = True
+
     GT = nx.DiGraph()
+    GT.graph["score"] = scoring or score
+    GT.graph["stats"] = stats or SearchStats()
+    GT.graph["max states"] = max_states
+    GT.graph["reduce"] = reduce
+    
+    # Optionally store every bus as an int bitmask
+    if bitmask:
+        I = bus_index()
+        GT.graph["index"] = I
+        GT.graph["goal mask"] = I.encode(G0)
+        B0 = I.encode(B0)
+    
     GT.graph["B0"] = B0
     GT.graph["G0"] = G0
-    GT.add_node(B0, done=False, test=test_b(G0, B0), valid=True)
-    score(B0, GT)
-    
-    # Main loop
-    def find_next():
-        done = test(GT)
-        try:
-            while True:
-                best_h = select_next(GT)
-                if best_h:
-                    generate_and_validate(GT, G0, best_h)
-                    done = test(GT)
-                    if done:
-                        # Find all paths
-                        for best_path in nx.all_shortest_paths(GT, source=B0, target=done):
-                        
-                            # Print output
-                            if verbose == 2:
-                                print("Found:")
-                                printlst(best_path)
-                        
-                            yield done, best_path
-                        
-                        if verbose:
-                            print("Next")
-                        
+    GT.graph["cone"] = required(bus_index(), bus_index().encode(G0), as_mask(GT, B0)) if cone else None
+    GT.add_node(B0, done=False, test=test_b(G0, as_items(GT, B0)), valid=True)
+    init_frontier(GT)
+    GT.graph["score"](B0, GT)
+    add_to_frontier(GT, B0)
+    
+    # The backward search starts from the one bus holding the whole cone
+    if direction != "forward":
+        GB = nx.DiGraph(direction=direction, top=B0 | GT.graph["cone"])
+        init_frontier(GB)
+        GB.add_node(GB.graph["top"], done=False, test=GB.graph["top"] == B0, score=width(GT.graph["cone"]))
+        add_to_frontier(GB, GB.graph["top"])
+        GT.graph["back"] = GB
+    return GT
+
+def find_paths(GT, verbose=False, claim=None, stop=None):
+    """ Runs the best first search on {GT}, yielding every goal bus found along with each shortest path to it. A bus is only expanded if {claim}(bus) is not False, and the search ends early once {stop}() is True. """
+    B0 = GT.graph["B0"]
+    try:
+        while True:
+            done = test(GT)
+            if done is not None:
+                # Find all paths, or one of each set of interleavings with the same rank
+                if GT.graph["reduce"]:
+                    paths = distinct_paths(GT, B0, done)
                 else:
+                    paths = nx.all_shortest_paths(GT, source=B0, target=done)
+                for best_path in paths:
+                    best_path = [as_items(GT, b) for b in best_path]
+                
+                    # Print output
                     if verbose == 2:
-                        print("None Found.")
-                    raise StopIteration
-                    
-        except KeyboardInterrupt:
-            raise StopIteration
+                        print("Found:")
+                        printlst(best_path)
+                
+                    yield done, best_path
+                
+                if verbose:
+                    print("Next")
+                continue
             
+            if stop is not None and stop():
+                return
+            t = time.perf_counter()
+            best_h = select_next(GT)
+            GT.graph["stats"].seconds["select"] += time.perf_counter()-t
+            if best_h is None:
+                if verbose == 2:
+                    print("None Found.")
+                return
+            if claim is not None and claim(best_h) is False:
+                GT.node[best_h]["done"] = True
+                continue
+            generate_and_validate(GT, GT.graph["G0"], best_h)
+                
+    except KeyboardInterrupt:
+        return
+
+def distinct_paths(GT, B0, target):
+    """ Yields the paths from {B0} to {target} in {GT}, skipping paths which only differ from another by swapping two neighbouring additions in a way that can not change their rank.
+        Busses only grow, so trim_path keeps an item of a bus if it is made into something on the second to last bus or into a goal.
+        Before the last addition, swapping two additions which are both, or both not, such ingredients only changes which items the one bus in between holds, not how many.
+        When both orders of such a pair are in {GT}, only the one adding the lower id first is followed. """
+    I = bus_index()
+    goal_pred = 0
+    for g in iter_bits(I.encode(GT.graph["G0"])):
+        goal_pred |= I.pred_mask[g]
+    
+    def between(p, i):
+        """ The bus {p} with the item of id {i} added. """
+        return p | 1 << i if GT.graph.get("index") is not None else p | {I.items[i]}
+    
+    def back(c, nxt, after, live):
+        if c == B0:
+            yield [c]
+            return
+        mask = as_mask(GT, c)
+        for p in GT.predecessors_iter(c):
+            a = (mask & ~as_mask(GT, p)).bit_length() - 1
+            if nxt is None:
+                # Choosing the second to last bus fixes which items are live
+                live = goal_pred
+                for i in iter_bits(mask & ~(1 << a)):
+                    live |= I.pred_mask[i]
+            elif nxt != target and a > after and (live >> a & 1) == (live >> after & 1):
+                m = between(p, after)
+                if GT.has_edge(p, m) and GT.has_edge(m, nxt):
+                    continue
+            for path in back(p, c, a, live):
+                path.append(c)
+                yield path
+    return back(target, None, None, None)
+
+# Backward Search
+def regress(GT, S):
+    """ Expands the bus {S} of the backward search of {GT}, adding a bus without each item that could have been added to it last. Returns those busses. """
+    GB, I, B0 = GT.graph["back"], GT.graph["index"], GT.graph["B0"]
+    goal_mask = GT.graph["goal mask"]
+    stats = GT.graph["stats"]
+    GB.node[S]["done"] = True
+    stats.expanded(GT)
+    stats.regressions += 1
+    
+    # Only items no other added item is made from can come last, and a path ends as soon as it holds every goal
+    added, used = S & ~B0, 0
+    for i in iter_bits(added):
+        used |= I.pred_mask[i]
+    out = []
+    for x in iter_bits(added & ~used):
+        p = S & ~(1 << x)
+        if p & goal_mask == goal_mask:
+            continue
+        if p not in GB:
+            GB.add_node(p, done=False, test=p == B0, score=width(p & ~B0))
+            add_to_frontier(GB, p)
+        GB.add_edge(p, S)
+        out.append(p)
+    return out
+
+def meet_paths(GT, verbose=False, stop=None):
+    """ Like find_paths, for a search made with init_search direction "backward" or "both".
+        The backward search removes one item at a time from the bus holding the whole cone, diving towards {B0} first.
+        With "both", each step also expands the best forward bus. A path is yielded every time an edge joins a bus of one search to a bus of the other. """
+    GB, B0 = GT.graph["back"], GT.graph["B0"]
+    top, forward = GB.graph["top"], GB.graph["direction"] == "both"
+    stats = GT.graph["stats"]
+    
+    def joined(p, S):
+        path = nx.shortest_path(GT, B0, p) + nx.shortest_path(GB, S, top)
+        if verbose == 2:
+            print("Met at:")
+            printlst(as_items(GT, p))
+        return top, [as_items(GT, b) for b in path]
+    
+    if top == B0:
+        yield top, [as_items(GT, B0)]
+        return
+    try:
+        while stop is None or not stop():
+            t = time.perf_counter()
+            h = select_next(GT) if forward else None
+            S = select_next(GB)
+            stats.seconds["select"] += time.perf_counter()-t
+            if h is None and S is None:
+                return
+            if h is not None:
+                generate_and_validate(GT, GT.graph["G0"], h)
+                for c in GT.successors_iter(h):
+                    if c in GB:
+                        yield joined(h, c)
+            if S is not None:
+                for p in regress(GT, S):
+                    if p in GT:
+                        yield joined(p, S)
+    except KeyboardInterrupt:
+        return
+
+def rank(trim_p):
+    """ How good a trimmed path is: its maximum bus width, then its length, then its mean bus width. Lower is better. """
+    lengths = [len(p) for p in trim_p]
+    return max(lengths), len(trim_p), np.mean(lengths)
+
+# Anytime API
+def iter_solutions(G0, B0, max_n=None, time_limit=None, max_expansions=None, bitmask=False, scoring=None, stats=None, verbose=False, max_states=None, reduce=True, cone=False, direction="forward", claim=None, stop=None):
+    """ Yields (trimmed path, max width, length, mean width) each time a better path is found. Paths that trim the same are only checked once. Stops once more than {max_n} paths have been checked, {time_limit} seconds have passed, {max_expansions} busses have been expanded or {stop}() is True. The search is counted and timed in {stats}, if given a SearchStats, and holds at most about {max_states} busses, if given. Paths that can not rank differently from one already checked are skipped if {reduce}. {cone} and {direction} are passed on to init_search, {claim} to find_paths. """
+    assert valid(G0, B0), "Goal {} can not be supplied by the starting bus {}.".format(G0, B0)
+    deadline = time.time() + time_limit if time_limit is not None else None
+    GT = init_search(G0, B0, bitmask=bitmask, scoring=scoring, stats=stats, max_states=max_states, reduce=reduce, cone=cone, direction=direction)
+    stats = GT.graph["stats"]
+    
+    def out_of_budget():
+        return (deadline is not None and time.time() >= deadline) or (max_expansions is not None and stats.expansions >= max_expansions) or (stop is not None and stop())
+    
+    best_rank, n = None, 0
+    if direction != "forward":
+        assert claim is None, "Only the forward search can claim busses."
+        found = meet_paths(GT, verbose=verbose, stop=out_of_budget)
+    else:
+        found = find_paths(GT, verbose=verbose, claim=claim, stop=out_of_budget)
+    paths = (path for h, path in found)
+    for trim_p in trim_paths(paths, G0, stats):
+        r = rank(trim_p)
+        if best_rank is None or r < best_rank:
+            best_rank = r
+            yield (trim_p,) + r
+        
+        # Breakout
+        if (max_n is not None and n > max_n) or out_of_budget():
+            return
+        n += 1
+
+def solve(G0, B0, callback=None, **kwargs):
+    """ Runs iter_solutions until its budget runs out, calling {callback} with each improved solution. Returns the best (trimmed path, max width, length, mean width), or None if no path was found in time. """
+    best = None
+    for best in iter_solutions(G0, B0, **kwargs):
+        if callback is not None:
+            callback(*best)
+    return best
+
+def main(G0, B0, max_n = 500, verbose=True, bitmask=False, max_states=None, max_expansions=2000, time_limit=60., stats=None):
+    """ Prints each better bus found by iter_solutions and returns the best trimmed path and its max width. A goal bus is only reported once, so {max_n} alone does not bound the search; it also stops after {max_expansions} busses or {time_limit} seconds. """
     # Look for the minimum of the maximum bus lengths
-    best_path, best_score, best_mean_lengths, n = None, None, None, 0
+    best_path, best_rank = None, None
     def announce_save(new=True):
-        if verbose:
+        if verbose and best_path is not None:
+            best_score, length, best_mean_lengths = best_rank
             if new:
-                print("\n========== New Best Score: {} Length: {} Mean: {} ==============".format(best_score, len(best_path), best_mean_lengths))
+                print("\n========== New Best Score: {} Length: {} Mean: {} ==============".format(best_score, length, best_mean_lengths))
             else:
-                print("\n========== Best Score: {} Length: {} Mean: {} ==============".format(best_score, len(best_path), best_mean_lengths))
+                print("\n========== Best Score: {} Length: {} Mean: {} ==============".format(best_score, length, best_mean_lengths))
             
             printlst(*best_path)
                 
@@ -269,43 +805,220 @@ def main(G0, B0, max_n = 500, verbose=True):
                 if removed:
                     declare(removed=removed)
                     
-    for h, path in find_next():
-        trim_p = trim_path(path, G0)
-        lengths = [len(p) for p in trim_p]
-        mean_lengths = np.mean(lengths)
-        max_score = max(lengths)
+    for trim_p, max_score, length, mean_lengths in iter_solutions(G0, B0, max_n=max_n, bitmask=bitmask, verbose=verbose, max_states=max_states, max_expansions=max_expansions, time_limit=time_limit, stats=stats):
+        best_path, best_rank = trim_p, (max_score, length, mean_lengths)
+        announce_save()
+    
+    announce_save(new=False)
+    return best_path, best_rank[0] if best_rank else None
+
+# Exact Search
+def required(I, goal_mask, start_mask):
+    """ Mask of the goals and every ingredient of them which is not on the starting bus. Each item has one recipe, so every path to the goals adds exactly these items or more. """
+    out, todo = 0, goal_mask & ~start_mask
+    while todo:
+        i = todo.bit_length() - 1
+        todo &= ~(1 << i)
+        out |= 1 << i
+        todo |= I.pred_mask[i] & ~start_mask & ~out
+    return out
+
+def solve_exact(G0, B0, time_limit=None):
+    """ Finds the path from {B0} to the goals {G0} with the smallest max trimmed bus width, then length, then mean width, and proves it.
+        Returns ((trimmed path, max width, length, mean width), certificate), where the certificate holds the untrimmed path, the lower bound on the rank, whether it is met, and the work done.
+        If {time_limit} seconds pass first, the best path so far is returned with optimal False.
         
-        # If this is the first iteration
-        if best_score is None:
-            best_path, best_score, best_mean_lengths = trim_p, max_score, mean_lengths
-            announce_save()
-            
-        # If the max score is better than best score
-        elif max_score < best_score:
-            best_path, best_score, best_mean_lengths = trim_p, max_score, mean_lengths
-            announce_save()
-            
-        # If not a shorter max width, a shorter length
-        elif len(trim_p) < len(best_path):
-            best_path, best_score, best_mean_lengths = trim_p, max_score, mean_lengths
-            announce_save()
+        Like find_paths, a path ends with the first bus holding every goal. Dropping an item which is not required from every bus of a path never makes a trimmed bus wider,
+        so the best paths add exactly the required items, which fixes the length, and the last item added is a goal.
+        Busses only grow, so trim_path keeps each bus before the last two to the items made into something on the second to last bus or into a goal, and these widths never shrink.
+        The max width is therefore set by the last two items added alone, and each pair is bounded exactly. For the pairs with the smallest max width,
+        the order of the other items is searched depth first for the smallest total width, bounded by the width so far plus the smallest widths the items still to place could add. """
+    assert valid(G0, B0), "Goal {} can not be supplied by the starting bus {}.".format(G0, B0)
+    start, deadline = time.time(), time.time() + time_limit if time_limit is not None else None
+    I, G0, B0 = bus_index(), frozenset(G0), frozenset(B0)
+    goal, b0 = I.encode(G0), I.encode(B0, strict=False)
+    R = required(I, goal, b0)
+    T, n = b0 | R, width(R) + 1
+    goal_pred = 0
+    for g in iter_bits(goal):
+        goal_pred |= I.pred_mask[g]
+    
+    def make(items):
+        path = [B0]
+        for i in items:
+            path.append(path[-1] | {I.items[i]})
+        trim_p = trim_path(path, G0)
+        return path, (trim_p,) + rank(trim_p)
+    
+    if not R:
+        path, best = make([])
+        return best, {"path": path, "lower_bound": best[1:], "optimal": True, "nodes": 0, "seconds": time.time()-start}
+    
+    # The max width of every choice of last two items, (y, z), y being None on a one item path
+    pairs = []
+    for z in iter_bits(R & goal):
+        if I.succ_mask[z] & R:
+            continue
+        live = goal_pred
+        for i in iter_bits(T & ~(1 << z)):
+            live |= I.pred_mask[i]
+        top = max(width(T & ~(1 << z) & goal_pred), width(goal))
+        if n == 2:
+            pairs.append((top, None, z, live))
+        for y in iter_bits(R & ~(1 << z)):
+            if not I.succ_mask[y] & R & ~(1 << z):
+                pairs.append((max(top, width(T & ~(1 << y) & ~(1 << z) & live)), y, z, live))
+    max_width = min(p[0] for p in pairs)
+    
+    # Total width of the order of the other items, for each pair with the smallest max width
+    pairs = sorted(p for p in pairs if p[0] == max_width)
+    best, nodes = [float("inf"), None], [0]
+    class OutOfTime(Exception):
+        pass
+    
+    # Every ingredient, direct or not, of each item
+    anc = [0]*len(I.items)
+    for i in range(len(I.items)):
+        for p in iter_bits(I.pred_mask[i]):
+            anc[i] |= (1 << p) | anc[p]
+    
+    def future(bus, left, live):
+        """ The least the busses still to come add to the total. Each is {bus} plus the live items placed since, and an item which is not live can only be placed after its live ingredients still to place. """
+        now, need = width(bus & live), sorted(width(anc[i] & left & live) for i in iter_bits(left & ~live))
+        total, placed, k = 0, 0, 0
+        for _ in range(width(left)):
+            if k < len(need) and need[k] <= placed:
+                k += 1
+            else:
+                placed += 1
+            total += now + placed
+        return total
+    
+    def order(bus, total, left, live, end, placed, tail, memo):
+        nodes[0] += 1
+        if deadline is not None and nodes[0] % 1024 == 0 and time.time() >= deadline:
+            raise OutOfTime()
+        if memo.get(bus, float("inf")) <= total:
+            return
+        memo[bus] = total
         
-        # If not a shorter length, a shorter average width
-        elif mean_lengths < best_mean_lengths:
-            best_path, best_score, best_mean_lengths = trim_p, max_score, mean_lengths
-            announce_save()
-            
-        # Print no better if verbose
-        elif verbose:
-            print("\nNo better: Score: {} Length: {} Mean: {}".format(best_score, len(best_path), best_mean_lengths))
+        # Once only live items are left, every order of them adds the same width
+        free = left & ~live
+        if not free:
+            rest = list(iter_bits(left))
+            for i in rest:
+                bus |= 1 << i
+                total += width(bus & live)
+            if total + end < best[0]:
+                best[:] = [total + end, placed + rest + tail]
+            return
+        if total + end + future(bus, left, live) >= best[0]:
+            return
         
-        # Breakout
-        if n > max_n:
-            break
-        n += 1
+        # Placing an item that is not live as soon as it can be made never costs anything
+        creatable = [i for i in iter_bits(left) if not I.pred_mask[i] & ~bus]
+        choices = [i for i in creatable if free >> i & 1][:1]
+        if not choices:
+            # Live items which are not needed for an item that is not live are best left for last, and those needed for the item closest to being made go first
+            closest = {}
+            for f in iter_bits(free):
+                d = width(anc[f] & left)
+                for i in iter_bits(anc[f] & left):
+                    closest[i] = min(closest.get(i, d), d)
+            choices = sorted((i for i in creatable if i in closest), key=closest.get)
+        for i in choices:
+            nxt = bus | 1 << i
+            order(nxt, total + width(nxt & live), left & ~(1 << i), live, end, placed + [i], tail, memo)
     
-    announce_save(new=False)
-    return best_path, best_score
+    def first(live):
+        """ Width of the starting bus, unless it is the second to last bus. """
+        return width(b0 & live) if n > 2 else 0
+    
+    # The last two busses, then the goals, add a fixed width to every order of the other items
+    jobs = []
+    for _, y, z, live in pairs:
+        tail = [i for i in (y, z) if i is not None]
+        left = R & ~sum(1 << i for i in tail)
+        end = width(T & ~(1 << z) & goal_pred) + width(goal)
+        jobs.append((first(live) + end + future(b0, left, live), left, live, end, tail))
+    
+    # Ids are topological, so placing the items in id order always gives a first path
+    _, left, live, end, tail = jobs[0]
+    bus, total = b0, first(live)
+    for i in iter_bits(left):
+        bus |= 1 << i
+        total += width(bus & live)
+    best[:] = [total + end, list(iter_bits(left)) + tail]
+    
+    unfinished = [job[0] for job in jobs]
+    try:
+        for k, (_, left, live, end, tail) in enumerate(jobs):
+            order(b0, first(live), left, live, end, [], tail, {})
+            unfinished[k] = float("inf")
+    except OutOfTime:
+        pass
+    
+    path, solution = make(best[1])
+    assert solution[1] == max_width and solution[2] == n and abs(solution[3]*n - best[0]) < 1e-9, "The best path should meet its bound."
+    bound = min([best[0]] + unfinished)
+    return solution, {"path": path, "lower_bound": (max_width, n, bound/n), "optimal": bound == best[0], "nodes": nodes[0], "seconds": time.time()-start}
+    
+# Parallel Search
+def _portfolio_worker(args):
+    """ Runs one search of a portfolio with iter_solutions. Worker 0 runs exactly main's search and publishes the busses it expands; the others skip busses already claimed in the shared transposition {table}, and stop once worker 0 is done. """
+    G0, B0, scoring, wid, table, finished, options = args
+    I = bus_index()
+    start = I.encode(B0)
+    
+    # Worker 0 publishes its expansions in batches, the others claim each one
+    published, checks = {}, [0]
+    def claim(h):
+        key = h if isinstance(h, int) else I.encode(h)
+        if key == start:
+            return True
+        if wid == 0:
+            published[key] = wid
+            if len(published) >= 64:
+                table.update(published)
+                published.clear()
+            return True
+        return table.setdefault(key, wid) == wid
+    
+    def stop():
+        checks[0] += 1
+        return wid != 0 and checks[0] % 64 == 0 and finished.is_set()
+    
+    best = None
+    for best in iter_solutions(G0, B0, scoring=scoring, claim=claim, stop=stop, **options):
+        pass
+    
+    if wid == 0:
+        finished.set()
+    return best
+
+def parallel_main(G0, B0, max_n=500, weights=(None, .1, .25, .5), bitmask=False, processes=None, max_expansions=2000, time_limit=60.):
+    """ Runs a portfolio of searches in parallel, one per scoring weight in {weights}, None being the default score. The first weight runs main's search with the same options, so for the same {max_n} and {max_expansions} the result is always at least as good as main's, unless {time_limit} runs out first. Returns the best trimmed path and its max width. """
+    assert valid(G0, B0), "Goal {} can not be supplied by the starting bus {}.".format(G0, B0)
+    
+    manager = mp.Manager()
+    table, finished = manager.dict(), manager.Event()
+    scorings = [score if p is None else partial(score_with_min_length, p=p) for p in weights]
+    options = {"max_n": max_n, "bitmask": bitmask, "max_expansions": max_expansions, "time_limit": time_limit}
+    jobs = [(G0, B0, scoring, wid, table, finished, options) for wid, scoring in enumerate(scorings)]
+    
+    pool = mp.Pool(processes or len(jobs))
+    try:
+        results = pool.map(_portfolio_worker, jobs)
+    finally:
+        pool.close()
+        pool.join()
+        manager.shutdown()
+    
+    results = [r for r in results if r is not None]
+    if not results:
+        return None, None
+    best_path, best_width = min(results, key=lambda r: r[1:])[:2]
+    return best_path, best_width
     
 if __name__=="__main__":
     # Starting Bus
@@ -315,4 +1028,4 @@ if __name__=="__main__":
     # Goal
     G0 = frozenset(["Science Pack 1", "Science Pack 2", "Science Pack 3", "Production Science Pack", "Military Science Pack", "High Tech Science Pack"])
 
-    main(G0, B0)
\ No newline at end of file
+    main(G0, B0, max_expansions=2000, time_limit=60.)
\ No newline at end of file
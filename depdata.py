@@ -1,32 +1,73 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-
 import pandas as pd
 import networkx as nx
+import numpy as np
 import math
+import os
+import hashlib
+import pickle
+import itertools
+import json
+import warnings
+
+try:
+    from scipy import sparse
+    from scipy.sparse import linalg as sparse_linalg
+except ImportError:
+    sparse = None
 
 # Import Data
-data = pd.read_csv("./assets/Factorio Science - Dependencies.csv")
+here = os.path.dirname(os.path.abspath(__file__))
+csv_path = os.path.join(here, "assets", "Factorio Science - Dependencies.csv")
+cache_dir = os.path.join(here, ".cache")
 
-# Make everything title case
-data["Parent"]  = data["Parent"].str.title()
-data["Child 1"] = data["Child 1"].str.title()
-data["Child 2"] = data["Child 2"].str.title()
-data["Child 3"] = data["Child 3"].str.title()
+def read_data(path):
+    """ Reads the recipe CSV at {path}. """
+    data = pd.read_csv(path)
+    
+    # Make everything title case
+    return title_case(data, ["Parent", "Child 1", "Child 2", "Child 3"])
 
-def main(TIMECONSTANT=1, save=True, name="out", outdir="./output/"):
+_data = None
+def load_data():
+    """ The recipe CSV, read on first use. """
+    global _data
+    if _data is None:
+        _data = read_data(csv_path)
+    return _data
 
-    # Create Graph
-    G = nx.DiGraph(TIMECONSTANT=1)
-    G.graph['graph']={'rankdir':'LR','label':"Time Constant: {}s".format(TIMECONSTANT)}
-    
-    # Add nodes to Graph with data
-    node_data = data[["Parent","Time","Output"]]
-    for i, d in node_data.iterrows():
-        G.add_node(d["Parent"],Time=d["Time"],QuantityOut=d["Output"])
-        
-    # Format Data into a relational format
+class Lazy(object):
+    """ Stands in for the object returned by {build}(), which is only called on first use. """
+    def __init__(self, build):
+        self._build = build
+        self._obj = None
+
+    def _get(self):
+        if self._obj is None:
+            self._obj = self._build()
+        return self._obj
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._get(), name)
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __contains__(self, key):
+        return key in self._get()
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+# The goals, each demanded once
+science_packs = ["Science Pack 1","Science Pack 2","Science Pack 3","Military Science Pack","Production Science Pack","High Tech Science Pack"]
+
+def relational(data):
+    """ Formats the Child 1..3 and Amount 1..3 columns of {data} into one (Parent, Child, Amount) row per ingredient. """
     ## Select each child individually
     D = [data[["Parent","Child {}".format(i+1),"Amount {}".format(i+1)]].copy() for i in range(3)]
     
@@ -39,68 +80,56 @@ def main(TIMECONSTANT=1, save=True, name="out", outdir="./output/"):
         d.rename(index=str, columns={"Child {}".format(i+1): "Child", "Amount {}".format(i+1): "Amount"}, inplace=True)
     
     # Concatenate them
-    dependencies = pd.concat(D, ignore_index=True)            
-    
-    # Find independent nodes
-    independent = set()
-    for i, d in dependencies.iterrows():
-        if d["Parent"] not in G.nodes():
-            independent.add(d["Parent"])
-        if d["Child"] not in G.nodes():
-            independent.add(d["Child"])
-            
-    print("Independent: {}".format(independent))
-    # Add Edges to Graph
-    for i, d in dependencies.iterrows():
-        G.add_edge(d["Child"],d["Parent"],QuantityPer=d["Amount"])
+    return pd.concat(D, ignore_index=True)
+
+def label(attrs, out=""):
+    """ {out} followed by one "key: value" line per attribute in {attrs}, floats to two decimals. """
+    for k, v in attrs.items():
+        if k == "label":
+            continue
+        if isinstance(v,float):
+            out += str(k)+": "+'{0:.2f}'.format(v)+"\n"
+        else:
+            out += str(k)+": "+str(v)+"\n"
+    return out
+
+def main(TIMECONSTANT=1, save=True, name="out", outdir="./output/", path=None):
+    """ Labels the recipe graph of {path} with the demand and factories needed for one of each science pack every {TIMECONSTANT} seconds, and draws it if {save}.
+        The demand is solved on the same Recipes core as batch and Model. """
+    R = recipes(path)
+
+    # Create Graph
+    G = R.to_networkx()
+    G.graph["TIMECONSTANT"] = TIMECONSTANT
+    G.graph['graph']={'rankdir':'LR','label':"Time Constant: {}s".format(TIMECONSTANT)}
+    print("Independent: {}".format(set(R.roots())))
     
     # Update weights to fit with demand
-    def how_many_do_i_need(node):
-        if "QuantityNeeded" in G.node[node]:
-            return G.node[node]["QuantityNeeded"]
-        total = 0
-        customers = [n for n in G.nodes() if n in G.edge[node]]
-        for n in customers:
-            quantity_per = G.edge[node][n]["QuantityPer"]
-            total += quantity_per * how_many_do_i_need(n)
-        G.node[node]["QuantityNeeded"] = total # That way we don't recalculate anything unnecessarily
-        return total
-    
-    # TODO: Instead, get the nodes which have no parents algorithmically
-    roots = ["Science Pack 1","Science Pack 2","Science Pack 3","Military Science Pack","Production Science Pack","High Tech Science Pack"]
-    for n in roots:
-        G.node[n]["QuantityNeeded"] = 1
+    roots = science_packs
+    d = np.zeros(len(R))
+    d[[R.ids[n] for n in roots]] = 1
+    needed = solve_demand(R.matrix(), d, R.byproduct_matrix())
     
-    for n in G.nodes():
-        how_many_do_i_need(n)
+    # Factories needed to keep up, NaN for raw resources
+    quant_per = R.rate()*TIMECONSTANT
+    factories = needed/quant_per
+    
+    for i, n in enumerate(R.items):
+        G.node[n]["QuantityNeeded"] = needed[i]
         if "QuantityOut" in G.node[n]:
-            quantPer = (G.node[n]["QuantityOut"]/G.node[n]["Time"])*TIMECONSTANT
-            G.node[n]["QuantityPer"]=quantPer
-            G.node[n]["FactoriesNeeded"] = 1./((1./G.node[n]["QuantityNeeded"])*(quantPer))
-        #if "Time" in G.node[n]:
-        #    del G.node[n]["Time"]
+            G.node[n]["QuantityPer"] = quant_per[i]
+            G.node[n]["FactoriesNeeded"] = factories[i]
         
     # Plotting
     ## Make labels
     for n in G.nodes():
         #print(G.node[n])
-        out = str(n)+"\n"
-        for k, v in G.node[n].items():
-            if isinstance(v,float):
-                out += str(k)+": "+'{0:.2f}'.format(v)+"\n"
-            else:
-                out += str(k)+": "+str(v)+"\n"
+        out = label(G.node[n], str(n)+"\n")
         print(out)
         G.node[n]["label"]=out
         
     for n1,n2 in G.edges():
-        out = ""
-        for k, v in G.edge[n1][n2].items():
-            if isinstance(v,float):
-                out += str(k)+": "+'{0:.2f}'.format(v)+"\n"
-            else:
-                out += str(k)+": "+str(v)+"\n"
-        G.edge[n1][n2]["label"]=out
+        G.edge[n1][n2]["label"]=label(G.edge[n1][n2])
         
     ## Output
     if save:
@@ -108,40 +137,637 @@ def main(TIMECONSTANT=1, save=True, name="out", outdir="./output/"):
         
     return G
     
-def save_graph(G, name="out", outdir="./output/", nlabels=True, elabels=True):
-    """ Draws and saves a graph. """
-    from networkx.drawing.nx_pydot import write_dot
-    from subprocess import call
-    import os
-    G = G.copy()
+# Recipe Loaders
+class RecipeBuilder(object):
+    """ Interns item names to integer ids and collects the recipes as arrays, one chunk at a time. """
+    def __init__(self):
+        self.ids = {}
+        self.items = []
+        self.recipes = []
+        self.ingredients = []
+        self.byproducts = []
+
+    def intern(self, names):
+        """ The ids of {names}, giving new names the next free ids. """
+        codes, uniques = pd.factorize(np.asarray(names, dtype=object))
+        for u in uniques:
+            if u not in self.ids:
+                self.ids[u] = len(self.items)
+                self.items.append(u)
+        return np.array([self.ids[u] for u in uniques], dtype=np.int64)[codes]
+
+    def add(self, recipes, times, outputs, parents, children, amounts, byproducts=None):
+        """ Adds a chunk of recipes, with their crafting {times} and {outputs}, and a chunk of ingredients, {amounts}[k] of {children}[k] going into one {parents}[k]. {byproducts} are (makers, items, amounts) where making one {makers}[k] also gives {amounts}[k] of {items}[k]. """
+        self.recipes.append((self.intern(recipes), np.asarray(times, dtype=float), np.asarray(outputs, dtype=float)))
+        parents, children = self.intern(parents), self.intern(children)
+        self.ingredients.append((children, parents, np.asarray(amounts, dtype=float)))
+        if byproducts is not None and len(byproducts[0]):
+            makers, items, amounts = byproducts
+            self.byproducts.append((self.intern(items), self.intern(makers), np.asarray(amounts, dtype=float)))
+
+    def compiled(self):
+        """ The items, their Time and Output (NaN for raw resources), the child, parent and amount arrays of the ingredients and the item, maker and amount arrays of the byproducts. The last recipe given for an item wins. """
+        n = len(self.items)
+        time, output = np.full(n, np.nan), np.full(n, np.nan)
+        for ids, t, o in self.recipes:
+            time[ids], output[ids] = t, o
+        def columns(chunks):
+            if chunks:
+                return [np.concatenate(c) for c in zip(*chunks)]
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        child, parent, amount = columns(self.ingredients)
+        by_item, by_maker, by_amount = columns(self.byproducts)
+        return {"items": self.items, "time": time, "output": output, "child": child, "parent": parent, "amount": amount,
+                "by_item": by_item, "by_maker": by_maker, "by_amount": by_amount}
+
+def title_case(data, columns):
+    """ Makes everything in the {columns} of {data} title case. """
+    for c in columns:
+        data[c] = data[c].str.title()
+    return data
+
+def load_wide(path, chunksize=100000):
+    """ Compiles a recipe CSV in the Child 1..3 and Amount 1..3 layout, read {chunksize} rows at a time. """
+    builder, names = RecipeBuilder(), ["Parent", "Child 1", "Child 2", "Child 3"]
+    
+    # Names are read as strings, or a chunk where a column is empty would be read as floats
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype={c: str for c in names}):
+        chunk = title_case(chunk, names)
+        dependencies = relational(chunk)
+        builder.add(chunk["Parent"].values, chunk["Time"].values, chunk["Output"].values,
+                    dependencies["Parent"].values, dependencies["Child"].values, dependencies["Amount"].values)
+    return builder.compiled()
+
+def load_long(path, chunksize=100000):
+    """ Compiles a recipe CSV with one Parent, Child, Amount row per ingredient, read {chunksize} rows at a time. The Time and Output of each Parent's recipe may be on any of its rows. A recipe without ingredients has an empty Child. """
+    builder, names = RecipeBuilder(), ["Parent", "Child"]
+    for chunk in pd.read_csv(path, chunksize=chunksize, dtype={c: str for c in names}):
+        chunk = title_case(chunk, names)
+        recipes = chunk.dropna(subset=["Time"])
+        ingredients = chunk.dropna(subset=["Child"])
+        builder.add(recipes["Parent"].values, recipes["Time"].values, recipes["Output"].values,
+                    ingredients["Parent"].values, ingredients["Child"].values, ingredients["Amount"].values)
+    return builder.compiled()
+
+def load_json(path, chunksize=100000):
+    """ Compiles a recipe file with one JSON object per line, {"name": ..., "time": ..., "output": ..., "ingredients": {child: amount}, "byproducts": {item: amount}}, read {chunksize} lines at a time. Ingredients and the optional byproducts may also be lists of [item, amount] pairs, amounts being per one item made. A file holding a single JSON list of such objects is read at once. """
+    builder = RecipeBuilder()
+    with open(path) as f:
+        head = f.read(1024).lstrip()
+        f.seek(0)
+        if head.startswith("["):
+            chunks = [json.load(f)]
+        else:
+            lines = (json.loads(l) for l in f if l.strip())
+            chunks = iter(lambda: list(itertools.islice(lines, chunksize)), [])
+        for chunk in chunks:
+            names = [r["name"].title() for r in chunk]
+            ingredients = [(r["name"].title(), c.title(), a) for r in chunk for c, a in (r["ingredients"].items() if isinstance(r["ingredients"], dict) else r["ingredients"])]
+            parents, children, amounts = zip(*ingredients) if ingredients else ((), (), ())
+            byproducts = [(r["name"].title(), b.title(), a) for r in chunk for b, a in (r["byproducts"].items() if isinstance(r.get("byproducts"), dict) else r.get("byproducts", ()))]
+            builder.add(names, [r["time"] for r in chunk], [r.get("output", 1) for r in chunk], parents, children, amounts,
+                        list(zip(*byproducts)) if byproducts else None)
+    return builder.compiled()
+
+def load_recipes(path, chunksize=100000):
+    """ Compiles the recipe file at {path} with load_json for .json and .jsonl files, with load_long for CSVs with a Child column and with load_wide otherwise. """
+    if path.endswith(".json") or path.endswith(".jsonl"):
+        return load_json(path, chunksize)
+    if "Child" in pd.read_csv(path, nrows=0).columns:
+        return load_long(path, chunksize)
+    return load_wide(path, chunksize)
+
+# Compiled Recipes
+_compiled = {}
+compiled_version = 2
+def file_digest(path):
+    """ SHA-1 of the content of the file at {path}. """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def compile_recipes(path=None):
+    """ The items of the recipe file at {path}, their crafting Time and Output (NaN for raw resources), and one (child, parent, amount) entry per ingredient as arrays. Cached in cache_dir under the hash of the file's content, so only the first process to see a file has to parse it. """
+    path = path or csv_path
+    digest = file_digest(path)
+    if digest in _compiled:
+        return _compiled[digest]
+    
+    cache = os.path.join(cache_dir, "recipes-{}-{}.pickle".format(compiled_version, digest))
+    try:
+        with open(cache, "rb") as f:
+            compiled = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        compiled = load_recipes(path)
+        
+        # Written to a temporary file first so no process reads half a cache
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            with open(cache+".tmp", "wb") as f:
+                pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(cache+".tmp", cache)
+        except OSError:
+            pass
+    
+    _compiled[digest] = compiled
+    return compiled
+
+def recipe_graph(path=None):
+    """ Only the recipe graph, with Time and QuantityOut on each recipe and QuantityPer on each ingredient edge. Unlike main, nothing is solved, labelled or printed. """
+    return recipes(path).to_networkx()
+
+# Recipe Core
+def csr_ptr(rows, n):
+    """ Offsets into arrays sorted by {rows}, so that row i is [ptr[i]:ptr[i+1]]. """
+    ptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=ptr[1:])
+    return ptr
+
+def frozen(a):
+    """ Makes the array {a} read only. """
+    a.setflags(write=False)
+    return a
+
+class Recipes(object):
+    """ A compact, read only recipe graph. Items are interned to the ids 0..n-1 of {items}. The ingredients and products of each item are slices of CSR arrays, and the amounts, crafting {time}s and {output}s are NumPy columns, NaN for raw resources. {amount}[k] of {child}[k] go into one {parent}[k]; the last amount given for a pair wins. {byproducts} are (items, makers, amounts) arrays where making one {makers}[k] also gives {amounts}[k] of {items}[k]. """
+    def __init__(self, items, time, output, child, parent, amount, byproducts=None):
+        self.items = tuple(items)
+        self.ids = {n: i for i, n in enumerate(self.items)}
+        n = len(self.items)
+        self.time = frozen(np.array(time, dtype=float))
+        self.output = frozen(np.array(output, dtype=float))
+        child, parent = np.asarray(child, dtype=np.int32), np.asarray(parent, dtype=np.int32)
+        amount = np.asarray(amount, dtype=float)
+        
+        # Ingredients of item i are pred[pred_ptr[i]:pred_ptr[i+1]], with amount[k] of each pred[k]
+        order = np.lexsort((child, parent))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (parent[order][1:] != parent[order][:-1]) | (child[order][1:] != child[order][:-1])
+        order = order[last]
+        self.pred = frozen(child[order])
+        self.amount = frozen(amount[order])
+        self.pred_ptr = frozen(csr_ptr(parent[order], n))
+        
+        # Products of item i are succ[succ_ptr[i]:succ_ptr[i+1]]
+        parent = parent[order]
+        order = np.argsort(self.pred, kind="mergesort")
+        self.succ = frozen(parent[order])
+        self.succ_ptr = frozen(csr_ptr(self.pred, n))
+        
+        # Byproducts of making item i are by[by_ptr[i]:by_ptr[i+1]], with by_amount[k] of each by[k]
+        if byproducts is None:
+            byproducts = np.zeros(0), np.zeros(0), np.zeros(0)
+        item, maker = np.asarray(byproducts[0], dtype=np.int32), np.asarray(byproducts[1], dtype=np.int32)
+        order = np.argsort(maker, kind="mergesort")
+        self.by = frozen(item[order])
+        self.by_amount = frozen(np.asarray(byproducts[2], dtype=float)[order])
+        self.by_ptr = frozen(csr_ptr(maker[order], n))
+        self._order = None
+
+    @classmethod
+    def from_graph(cls, G):
+        """ The Recipes of a NetworkX recipe graph {G}, with Time and QuantityOut on its recipes and QuantityPer on its edges. """
+        items = G.nodes()
+        ids = {n: i for i, n in enumerate(items)}
+        edges = G.edges(data=True)
+        byproducts = [(ids[b], ids[n], a) for n in items for b, a in G.node[n].get("Byproducts", {}).items()]
+        return cls(items,
+                   [G.node[n].get("Time", np.nan) for n in items],
+                   [G.node[n].get("QuantityOut", np.nan) for n in items],
+                   [ids[c] for c, p, d in edges], [ids[p] for c, p, d in edges], [d["QuantityPer"] for c, p, d in edges],
+                   list(zip(*byproducts)) if byproducts else None)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, n):
+        return n in self.ids
+
+    def ingredients(self, i):
+        """ The ids of the ingredients of the item with id {i}, and how many of each go into one. """
+        lo, hi = self.pred_ptr[i], self.pred_ptr[i+1]
+        return self.pred[lo:hi], self.amount[lo:hi]
+
+    def products(self, i):
+        """ The ids of the items made from the item with id {i}. """
+        return self.succ[self.succ_ptr[i]:self.succ_ptr[i+1]]
+
+    def byproducts(self, i):
+        """ The ids of the byproducts of making the item with id {i}, and how many of each one item gives. """
+        lo, hi = self.by_ptr[i], self.by_ptr[i+1]
+        return self.by[lo:hi], self.by_amount[lo:hi]
+
+    def predecessors(self, n):
+        """ The names of the ingredients of the item {n}. """
+        return [self.items[c] for c in self.ingredients(self.ids[n])[0]]
+
+    def successors(self, n):
+        """ The names of the items made from the item {n}. """
+        return [self.items[p] for p in self.products(self.ids[n])]
+
+    def roots(self):
+        """ The names of the raw resources, made from nothing. """
+        return [self.items[i] for i in np.flatnonzero(np.diff(self.pred_ptr) == 0)]
+
+    def heads(self):
+        """ The names of the items made into nothing. """
+        return [self.items[i] for i in np.flatnonzero(np.diff(self.succ_ptr) == 0)]
+
+    def edges(self):
+        """ The child, parent and amount arrays, one entry per ingredient. """
+        return self.pred, np.repeat(np.arange(len(self.items), dtype=np.int32), np.diff(self.pred_ptr)), self.amount
+
+    def order(self):
+        """ The ids in topological order, ingredients before products, one layer of items at a time. Raises ValueError if the recipes contain a cycle. """
+        if self._order is None:
+            missing = np.diff(self.pred_ptr)
+            layer, out = np.flatnonzero(missing == 0), []
+            while len(layer):
+                out.append(layer)
+                products = np.concatenate([self.products(i) for i in layer])
+                np.subtract.at(missing, products, 1)
+                layer = np.unique(products[missing[products] == 0])
+            out = np.concatenate(out) if out else np.zeros(0, dtype=np.int64)
+            if len(out) < len(self.items):
+                raise ValueError("The recipes contain a cycle through {}.".format(self.items[np.flatnonzero(missing)[0]]))
+            self._order = frozen(out)
+        return self._order
+
+    def matrix(self):
+        """ The recipe matrix of ingredient_matrix. """
+        return ingredient_matrix(len(self.items), *self.edges())
+
+    def byproduct_matrix(self):
+        """ The matrix P where P[i, j] is how many of item i making one item j gives as a byproduct, or None if nothing does. """
+        if not len(self.by):
+            return None
+        return ingredient_matrix(len(self.items), self.by, np.repeat(np.arange(len(self.items), dtype=np.int32), np.diff(self.by_ptr)), self.by_amount)
+
+    def rate(self):
+        """ Items crafted per second by one factory, NaN for raw resources. """
+        return self.output/self.time
+
+    def to_networkx(self):
+        """ The recipe graph as a NetworkX DiGraph, for rendering. """
+        G = nx.DiGraph()
+        for n, t, o in zip(self.items, self.time, self.output):
+            if np.isnan(t):
+                G.add_node(n)
+            else:
+                G.add_node(n, Time=t, QuantityOut=o)
+        for i in np.flatnonzero(np.diff(self.by_ptr)):
+            G.node[self.items[i]]["Byproducts"] = {self.items[b]: a for b, a in zip(*self.byproducts(i))}
+        G.add_edges_from((self.items[c], self.items[p], {"QuantityPer": a}) for c, p, a in zip(*self.edges()))
+        return G
+
+def as_recipes(G):
+    """ {G} if it is already Recipes, else the Recipes of the NetworkX recipe graph {G}. """
+    if isinstance(G, Lazy):
+        G = G._get()
+    return G if isinstance(G, Recipes) else Recipes.from_graph(G)
+
+_recipes = {}
+def recipes(path=None):
+    """ The Recipes of the recipe file at {path}, built once per file content. """
+    digest = file_digest(path or csv_path)
+    if digest not in _recipes:
+        r = compile_recipes(path)
+        _recipes[digest] = Recipes(r["items"], r["time"], r["output"], r["child"], r["parent"], r["amount"], (r["by_item"], r["by_maker"], r["by_amount"]))
+    return _recipes[digest]
+
+# Demand
+def recipe_matrix(items, dependencies):
+    """ Coefficient matrix A of the recipes, where A[i, j] is how many of {items}[i] go into one {items}[j]. Sparse if scipy is available. Only the ingredient_matrix of a (Parent, Child, Amount) table, Recipes.matrix is the one demand is solved on. """
+    ids = {n: i for i, n in enumerate(items)}
+    return ingredient_matrix(len(items), dependencies["Child"].map(ids).values, dependencies["Parent"].map(ids).values, dependencies["Amount"].values)
+
+def ingredient_matrix(n, child, parent, amount):
+    """ The n x n recipe matrix with {amount}[k] of item {child}[k] going into one item {parent}[k]. """
+    amount = np.asarray(amount, dtype=float)
+    if sparse is not None:
+        return sparse.csr_matrix((amount, (child, parent)), shape=(n, n))
+    A = np.zeros((n, n))
+    np.add.at(A, (child, parent), amount)
+    return A
+
+def recipe_depth(A):
+    """ Number of layers of the recipe matrix {A}, each item made only from items of earlier layers, or None if the recipes loop. """
+    n = A.shape[0]
+    child, parent = A.nonzero()
+    order = np.argsort(child, kind="mergesort")
+    succ, ptr = parent[order], csr_ptr(child[order], n)
+    missing = np.bincount(parent, minlength=n)
+    layer, placed, depth = np.flatnonzero(missing == 0), 0, 0
+    while len(layer):
+        placed, depth = placed + len(layer), depth + 1
+        products = np.concatenate([succ[ptr[i]:ptr[i+1]] for i in layer])
+        np.subtract.at(missing, products, 1)
+        layer = np.unique(products[missing[products] == 0])
+    return depth if placed == n else None
+
+def solve_demand(A, d, P=None):
+    """ Total demand x = A x + d for a goal vector {d} or a matrix with one goal vector per column. If the recipes are a DAG, sweeping x = A x + d reaches the exact answer after as many sweeps as the recipes are deep. Recipes that loop, or that give the byproducts {P}, are left to solve_rates without sweeping. """
+    x = d = np.asarray(d, dtype=float)
+    depth = recipe_depth(A) if P is None else None
+    if depth is None:
+        return solve_rates(A, d, P)
+    for _ in range(depth + 1):
+        x_next = A.dot(x) + d
+        if np.array_equal(x_next, x):
+            break
+        x = x_next
+    return x_next
+
+def loop_order(M):
+    """ An order of the items of the sparse recipe matrix {M} with ingredients before products, as far as the loops allow. Each loop is broken at its item with the fewest ingredients left to place. """
+    C = sparse.coo_matrix(M)
+    C = C.row[C.row != C.col], C.col[C.row != C.col]
+    S = sparse.csr_matrix((np.ones(len(C[0])), C), shape=M.shape)
+    missing = np.diff(S.tocsc().indptr)
+    done, out = np.zeros(len(missing), dtype=bool), []
+    layer = np.flatnonzero(missing == 0)
+    while len(out) < len(missing):
+        if not len(layer):
+            left = np.flatnonzero(~done)
+            layer = left[[np.argmin(missing[left])]]
+        done[layer] = True
+        out.extend(layer)
+        products = np.concatenate([S.indices[S.indptr[i]:S.indptr[i+1]] for i in layer])
+        np.subtract.at(missing, products, 1)
+        layer = np.unique(products[(missing[products] <= 0) & ~done[products]])
+    return np.array(out, dtype=np.int64)
+
+def linear_solve(K, b):
+    """ Solves K x = b, sparse if {K} is. NaN where K is singular. A sparse {K} should list ingredients before products, as loop_order does, so its LU factors stay about as sparse as K. """
+    if sparse is not None and sparse.issparse(K):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", sparse_linalg.MatrixRankWarning)
+            return sparse_linalg.spsolve(K.tocsc(), b, permc_spec="NATURAL").reshape(b.shape)
+    try:
+        return np.linalg.solve(K, b)
+    except np.linalg.LinAlgError:
+        return np.full(b.shape, np.nan)
+
+def solve_rates(A, d, P=None, max_iter=None, tol=1e-9):
+    """ Total rate x of every item for a goal vector {d}, or a matrix with one goal vector per column, when the recipes may loop and making one item j may also give {P}[i, j] of item i as a byproduct. Each recipe only makes up what the byproducts fall short of, x = max(0, A x - P x + d). Solved with one sparse linear solve over the recipes that run, repeated while that set changes, at most {max_iter} times per goal vector. Raises ValueError if there are no such rates, as when a loop consumes more than it makes. """
+    d = np.asarray(d, dtype=float)
+    M = A if P is None else A - P
+    if sparse is not None and sparse.issparse(M):
+        K, order = sparse.csr_matrix(sparse.identity(A.shape[0]) - M), loop_order(M)
+    else:
+        K, order = np.eye(A.shape[0]) - M, np.arange(A.shape[0])
+
+    def solve(run, d):
+        x, idx = np.zeros(d.shape), order[run[order]]
+        x[idx] = linear_solve(K[idx][:, idx], d[idx])
+        if not np.all(np.isfinite(x)):
+            raise ValueError("The recipes loop and make no more than they consume.")
+        return x, tol*max(1., np.abs(x).max(initial=0.))
+
+    def checked(x, scale, d):
+        # Loops that multiply the rates many times over lose every digit to rounding
+        x = np.maximum(x, 0)
+        if np.abs(x - np.maximum(0, M.dot(x) + d)).max(initial=0.) > scale/tol**.5:
+            raise ValueError("The recipe loops multiply the rates too much to solve.")
+        return x
+
+    # Without byproducts every recipe runs
+    if P is None:
+        x, scale = solve(np.ones(len(d), dtype=bool), d)
+        if np.any(x < -scale):
+            raise ValueError("The recipes loop and consume more than they make.")
+        return checked(x, scale, d)
+    
+    # Start with every recipe running, then stop those whose item the byproducts cover and restart those that fall short.
+    # All of them at once while that finds new sets of recipes, then only the first, which can not cycle on a well posed plan
+    def plan(d):
+        run, seen = np.ones(len(d), dtype=bool), set()
+        for _ in range(max_iter or 4*len(d) + 1):
+            seen.add(run.tobytes())
+            x, scale = solve(run, d)
+            flip = (run & (x < -scale)) | (~run & (M.dot(x) + d > scale))
+            if not flip.any():
+                return checked(x, scale, d)
+            if (run ^ flip).tobytes() in seen:
+                flip[np.flatnonzero(flip)[1:]] = False
+            run = run ^ flip
+        raise ValueError("No rates cover the demand, the recipes loop and consume more than they make.")
+    if d.ndim == 2:
+        return np.column_stack([plan(d[:, k]) for k in range(d.shape[1])]).reshape(d.shape)
+    return plan(d)
+    
+# Batches
+_model = None
+def recipe_model():
+    """ The items, the recipe matrix, the crafting rate of every item per second and the byproduct matrix (None without byproducts), built once. Raw resources have a NaN rate. """
+    global _model
+    if _model is None:
+        R = recipes()
+        _model = list(R.items), R.matrix(), R.rate(), R.byproduct_matrix()
+    return _model
+
+def batch(timeconstants, goals=None, roots=science_packs):
+    """ Factories needed for many scenarios in one solve. Scenario k has the time constant {timeconstants}[k] and demands row k of {goals}, one column per item of {roots}, by default 1 of each. Returns the items and a (scenarios x items) matrix of factories needed, NaN for raw resources. """
+    items, A, rate, P = recipe_model()
+    timeconstants = np.asarray(timeconstants, dtype=float)
+    if goals is None:
+        goals = np.ones((len(timeconstants), len(roots)))
+    goals = np.asarray(goals, dtype=float)
+    assert goals.shape == (len(timeconstants), len(roots)), "goals should have one row per time constant and one column per root, not {}.".format(goals.shape)
+    
+    ids = {n: i for i, n in enumerate(items)}
+    d = np.zeros((len(items), len(timeconstants)))
+    d[[ids[n] for n in roots], :] = goals.T
+    needed = solve_demand(A, d, P)
+    return items, (needed/(rate[:, None]*timeconstants[None, :])).T
+    
+# Incremental Model
+class Model(object):
+    """ The recipe graph {G} (by default the recipe_graph of {path}) with QuantityNeeded, QuantityPer, FactoriesNeeded and a label kept on every item.
+        {goals} maps each demanded item to its amount, by default 1 of each science pack.
+        Editing a recipe only recomputes the items it draws on, so small edits cost time in proportion to the part of the graph they affect. """
+    def __init__(self, TIMECONSTANT=1, goals=None, path=None, G=None):
+        self.G = recipe_graph(path) if G is None else G
+        self.goals = dict.fromkeys(science_packs, 1) if goals is None else dict(goals)
+        self.order = {n: i for i, n in enumerate(nx.topological_sort(self.G))}
+        self.set_timeconstant(TIMECONSTANT)
+        self.update(self.G.nodes())
+        for n1, n2 in self.G.edges_iter():
+            self.relabel_edge(n1, n2)
+        
+    def update(self, changed):
+        """ Recomputes the demand of the items in {changed} and of every ingredient they draw on, each after all of its customers. Returns the items touched. """
+        G = self.G
+        touched, stack = set(changed), list(changed)
+        while stack:
+            for c in G.predecessors_iter(stack.pop()):
+                if c not in touched:
+                    touched.add(c)
+                    stack.append(c)
+        
+        for n in sorted(touched, key=self.order.get, reverse=True):
+            G.node[n]["QuantityNeeded"] = self.goals.get(n, 0) + sum(a*G.node[p]["QuantityNeeded"] for p, a in self.customers(n))
+            self.refresh(n)
+        return touched
+    
+    def customers(self, n):
+        """ Each item made from {n} with the amount of {n} it takes. """
+        return ((p, e["QuantityPer"]) for p, e in self.G.edge[n].items())
+        
+    def refresh(self, n):
+        """ Recomputes the factories and the label of {n} from its demand. """
+        attrs = self.G.node[n]
+        if "QuantityOut" in attrs:
+            attrs["QuantityPer"] = attrs["QuantityOut"]/attrs["Time"]*self.TIMECONSTANT
+            attrs["FactoriesNeeded"] = attrs["QuantityNeeded"]/attrs["QuantityPer"]
+        attrs["label"] = label(attrs, str(n)+"\n")
+        
+    def relabel_edge(self, n1, n2):
+        e = self.G.edge[n1][n2]
+        e["label"] = label(e)
+        
+    def set_recipe(self, n, ingredients=None, time=None, output=None):
+        """ Changes the recipe of {n}. {ingredients} maps each ingredient to its amount and replaces the old ones, {time} and {output} replace the crafting time and output.
+            Returns the items whose demand or factories were recomputed. """
+        G = self.G
+        touched = set()
+        if ingredients is not None:
+            late = [c for c in ingredients if c not in self.order or self.order[c] >= self.order[n]]
+            if any(c == n or (c in G and nx.has_path(G, n, c)) for c in late):
+                raise ValueError("{} would become an ingredient of itself.".format(n))
+            
+            old = set(G.predecessors(n))
+            G.remove_edges_from((c, n) for c in old - set(ingredients))
+            for c, a in ingredients.items():
+                G.add_edge(c, n, QuantityPer=a)
+                self.relabel_edge(c, n)
+            
+            # Only a new ingredient placed after {n} needs the order redone
+            if late:
+                self.order = {m: i for i, m in enumerate(nx.topological_sort(G))}
+            touched |= self.update(old | set(ingredients))
+        
+        if time is not None:
+            G.node[n]["Time"] = time
+        if output is not None:
+            G.node[n]["QuantityOut"] = output
+        if time is not None or output is not None:
+            self.refresh(n)
+            touched.add(n)
+        return touched
+    
+    def set_goal(self, n, amount):
+        """ Demands {amount} of {n}, 0 to drop it from the goals. Returns the items recomputed. """
+        if n not in self.G:
+            raise ValueError("{} is not an item of the model.".format(n))
+        if amount:
+            self.goals[n] = amount
+        else:
+            self.goals.pop(n, None)
+        return self.update([n])
+    
+    def set_timeconstant(self, TIMECONSTANT):
+        """ Every factory count scales with the time constant, but no demand changes. """
+        self.TIMECONSTANT = TIMECONSTANT
+        self.G.graph["TIMECONSTANT"] = TIMECONSTANT
+        self.G.graph['graph'] = {'rankdir':'LR','label':"Time Constant: {}s".format(TIMECONSTANT)}
+        for n in self.G.nodes_iter():
+            if "QuantityNeeded" in self.G.node[n]:
+                self.refresh(n)
+    
+    def save(self, name="out", outdir="./output/"):
+        """ Draws the model with save_graph, which skips drawings that have not changed. """
+        return save_graph(self.G, name=name, outdir=outdir)
+    
+# Rendering
+def dot_quote(x):
+    """ {x} as a quoted DOT id. """
+    return '"' + str(x).replace('"', '\\"') + '"'
+
+def dot_attrs(attrs):
+    """ {attrs} as a DOT attribute list. """
+    return "[" + ", ".join(str(k) + "=" + dot_quote(v) for k, v in attrs.items()) + "]"
+
+def to_dot(G, nlabels=True, elabels=True):
+    """ The DOT text of {G}, labelled as save_graph draws it. Labels are built on the fly, so {G} is neither copied nor changed. """
+    directed = G.is_directed()
+    lines = [("strict digraph" if directed else "strict graph") + " {"]
+    for k in ("graph", "node", "edge"):
+        if G.graph.get(k):
+            lines.append(k + " " + dot_attrs(G.graph[k]) + ";")
     
     # Add node labels
-    if nlabels:
-        for n in G.nodes():
-            G.node[n]["label"] = str(list(n))
-            for k, v in G.node[n].items():
+    for n, attrs in G.nodes_iter(data=True):
+        if nlabels:
+            label = str(list(n))
+            for k, v in attrs.items():
                 if k != "label":
-                    G.node[n]["label"] += "\n" + str(k) + ": " + str(v)
+                    label += "\n" + str(k) + ": " + str(v)
+            attrs = dict(attrs, label=label)
+        lines.append(dot_quote(n) + " " + dot_attrs(attrs) + ";")
     
     # Add edge labels
-    if elabels:
-        for n1, n2 in G.edges():
-            G.edge[n1][n2]["label"] = ""
-            for k, v in G.edge[n1][n2].items():
+    arrow = " -> " if directed else " -- "
+    for n1, n2, attrs in G.edges_iter(data=True):
+        if elabels:
+            label = ""
+            for k, v in attrs.items():
                 if k != "label":
-                    G.edge[n1][n2]["label"] += str(k) + ": " + str(v) + "\n"
-                
-    if not os.path.exists(outdir+name+"/"):
-        os.makedirs(outdir+name+"/")
-    write_dot(G,outdir+name+"/"+name+".dot")
-    call(["dot", "-Tpng", outdir+name+"/"+name+".dot", "-o", outdir+name+"/"+name+".png"])
-    call(["dot", "-Tpdf", outdir+name+"/"+name+".dot", "-o", outdir+name+"/"+name+".pdf"])
+                    label += str(k) + ": " + str(v) + "\n"
+            attrs = dict(attrs, label=label)
+        lines.append(dot_quote(n1) + arrow + dot_quote(n2) + " " + dot_attrs(attrs) + ";")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+def render(G, name, outdir, nlabels, elabels, formats, pool):
+    """ Writes {G} to {outdir}{name}/{name}.dot and submits one dot call per format to {pool}.
+        Nothing is submitted if the DOT text hashes the same as the saved one and every format exists.
+        Returns the paths being rendered and their futures. """
+    from subprocess import call
+    text = to_dot(G, nlabels, elabels).encode("utf-8")
+    folder = os.path.join(outdir, name)
+    path = os.path.join(folder, name + ".dot")
+    outputs = [os.path.join(folder, name + "." + fmt) for fmt in formats]
+    if os.path.exists(path) and all(os.path.exists(out) for out in outputs):
+        with open(path, "rb") as f:
+            if hashlib.sha1(f.read()).digest() == hashlib.sha1(text).digest():
+                return []
+    
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(path, "wb") as f:
+        f.write(text)
+    return [(out, pool.submit(call, ["dot", "-T" + fmt, path, "-o", out])) for fmt, out in zip(formats, outputs)]
+
+def save_graphs(graphs, outdir="./output/", nlabels=True, elabels=True, formats=("png", "pdf"), workers=None):
+    """ Draws and saves each (graph, name) pair in {graphs}, running every format of every graph through one pool of {workers}.
+        Returns the paths rendered for each graph, empty where the saved drawing was already up to date. """
+    from concurrent.futures import ThreadPoolExecutor
+    graphs = list(graphs)
+    with ThreadPoolExecutor(workers) as pool:
+        jobs = [render(G, name, outdir, nlabels, elabels, formats, pool) for G, name in graphs]
+        out = []
+        for job, (G, name) in zip(jobs, graphs):
+            # A failed render must not leave a DOT file behind to be mistaken for an up to date drawing
+            if any(f.result() != 0 for _, f in job):
+                os.remove(os.path.join(outdir, name, name + ".dot"))
+            out.append([path for path, _ in job])
+    return out
+
+def save_graph(G, name="out", outdir="./output/", nlabels=True, elabels=True, formats=("png", "pdf")):
+    """ Draws and saves a graph, rendering its {formats} at the same time. Returns the paths rendered. """
+    return save_graphs([(G, name)], outdir, nlabels, elabels, formats)[0]
 
 def min_one_factory_optimize(save=True, name="out", outdir="./output/"):
     """ Chooses a time constant which would have the minimum number of factories precisely equal 1. """
-    G = main(TIMECONSTANT=1,save=False)
-    num_factories = [G.node[n]["FactoriesNeeded"] for n in G.nodes() if "FactoriesNeeded" in G.node[n]]
-    out = G.graph["TIMECONSTANT"]*float(min(num_factories))
+    items, num_factories = batch([1])
+    out = float(np.nanmin(num_factories))
     return main(out, save=save, name=name, outdir=outdir)
     
 if __name__=="__main__":
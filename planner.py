@@ -0,0 +1,220 @@
+""" Answers bus queries from a long running process, so the recipe graph, its BusIndex and earlier answers stay warm between queries.
+
+Queries are JSON objects, read one per line from stdin or POSTed over HTTP. A JSON list of queries is run as one batch, at the same time:
+    {"id": 1, "goals": ["Science Pack 1", "Science Pack 2"], "start": ["Iron Plate", "Copper Plate"], "max_expansions": 2000}
+"start" defaults to the raw resources. Set "exact" to prove the best bus with solve_exact instead. Any of search_options are passed on to bus.solve.
+Identical queries, within a batch or asked again later, are only run once. Other queries share nothing but the warm BusIndex of the worker they run on, which keeps the distance tables of the last starting busses.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import bus
+
+# Queries
+search_options = ("max_n", "time_limit", "max_expansions", "max_states", "reduce", "cone", "direction")
+numeric_options = ("max_n", "time_limit", "max_expansions", "max_states")
+flag_options = ("reduce", "cone", "exact")
+directions = ("forward", "backward", "both")
+defaults = {"max_expansions": 2000}
+
+def warm():
+    """ Builds the recipe graph and its BusIndex, once per process. """
+    bus.bus_index()
+
+def check(query):
+    """ Why {query} can not be run, or None if it can. """
+    if not isinstance(query, dict):
+        return "A query must be a JSON object."
+    for k in ("goals", "start"):
+        items = query.get(k)
+        if (k == "goals" or items is not None) and not (isinstance(items, list) and items and all(isinstance(n, str) for n in items)):
+            return "{} must be a non empty list of item names.".format(k)
+    for k in numeric_options:
+        v = query.get(k)
+        if v is not None and (isinstance(v, bool) or not isinstance(v, (int, float)) or v < 0):
+            return "{} must be a non negative number or null.".format(k)
+    for k in flag_options:
+        if not isinstance(query.get(k, False), bool):
+            return "{} must be true or false.".format(k)
+    if query.get("direction", "forward") not in directions:
+        return "direction must be one of {}.".format(", ".join(directions))
+
+def key(query, roots):
+    """ Everything the answer to {query} depends on: its goals, its starting bus, or {roots} if none, and its options. """
+    options = tuple(sorted((k, json.dumps(query[k])) for k in search_options if k in query))
+    return frozenset(query["goals"]), frozenset(query.get("start") or roots), bool(query.get("exact")), options
+
+def run(query):
+    """ Answers one {query} in this process. Returns a dict of the best path found and its rank, or of the error. """
+    t = time.time()
+    try:
+        G0, B0 = frozenset(query["goals"]), frozenset(query["start"])
+        unknown = sorted(n for n in G0 | B0 if n not in bus.bus_index().ids)
+        if unknown:
+            return {"error": "Unknown items: {}".format(", ".join(unknown))}
+        if not bus.valid(G0, B0):
+            return {"error": "The goals can not be made from the starting bus."}
+
+        out = {}
+        if query.get("exact"):
+            best, certificate = bus.solve_exact(G0, B0, time_limit=query.get("time_limit"))
+            out.update(optimal=certificate["optimal"], lower_bound=list(certificate["lower_bound"]))
+        else:
+            options = dict(defaults)
+            options.update((k, query[k]) for k in search_options if k in query)
+            stats = bus.SearchStats()
+            best = bus.solve(G0, B0, bitmask=True, stats=stats, **options)
+            out.update(expansions=stats.expansions)
+    except Exception as e:
+        return {"error": "{}: {}".format(type(e).__name__, e)}
+
+    if best is None:
+        out.update(path=None)
+    else:
+        trim_p, max_width, length, mean_width = best
+        out.update(path=[sorted(b) for b in trim_p], max_width=max_width, length=length, mean_width=float(mean_width))
+    out.update(seconds=time.time()-t)
+    return out
+
+# Planner
+class Planner(object):
+    """ Runs queries on a pool of {processes} warm workers, keeping the answers to the last {cache_size} distinct queries. """
+    def __init__(self, processes=None, cache_size=1024):
+        warm()
+        self.roots = frozenset(bus.find_roots(bus.D))
+        self.pool = mp.Pool(processes, initializer=warm)
+        self.cache, self.cache_size = OrderedDict(), cache_size
+        self.lock = threading.Lock()
+        self.stats = {"queries": 0, "runs": 0, "hits": 0}
+
+    def lookup(self, k):
+        """ The cached answer to the query with key {k}, or None. """
+        with self.lock:
+            if k in self.cache:
+                self.cache.move_to_end(k)
+                return self.cache[k]
+
+    def store(self, k, answer):
+        """ Caches the {answer} to the query with key {k}, dropping the least recently used answers past cache_size. """
+        with self.lock:
+            self.cache[k] = answer
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def batch(self, queries):
+        """ Answers a list of {queries} at the same time, in order. Identical queries, answered before or asked more than once in the batch, are only run once. A query that fails only gets an error answer. """
+        keys, answers, pending, found = [], [], OrderedDict(), {}
+        for query in queries:
+            error = check(query)
+            if error is not None:
+                keys.append(error)
+                continue
+            k = key(query, self.roots)
+            keys.append(k)
+            if k in pending or k in found:
+                continue
+            found[k] = self.lookup(k)
+            if found[k] is None:
+                goals, start, exact, options = k
+                pending[k] = self.pool.apply_async(run, (dict(query, goals=sorted(goals), start=sorted(start)),))
+
+        for k in pending:
+            try:
+                found[k] = pending[k].get()
+            except Exception as e:
+                found[k] = {"error": "{}: {}".format(type(e).__name__, e)}
+            else:
+                self.store(k, found[k])
+
+        for query, k in zip(queries, keys):
+            if isinstance(k, str):
+                answer = {"error": k}
+            else:
+                answer = dict(found[k], cached=k not in pending)
+                pending.pop(k, None)
+            if isinstance(query, dict) and "id" in query:
+                answer.update(id=query["id"])
+            answers.append(answer)
+
+        with self.lock:
+            self.stats["queries"] += len(queries)
+            self.stats["hits"] += sum(a.get("cached", False) for a in answers)
+            self.stats["runs"] += sum(not a.get("cached", True) for a in answers)
+        return answers
+
+    def ask(self, request):
+        """ Answers a {request} that is either one query or a list of them. """
+        if isinstance(request, list):
+            return self.batch(request)
+        return self.batch([request])[0]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+# Interfaces
+def serve_lines(planner, lines=sys.stdin, out=sys.stdout):
+    """ Answers each JSON request in {lines} with a line of JSON on {out}. """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            answer = planner.ask(json.loads(line))
+        except ValueError as e:
+            answer = {"error": "Bad JSON: {}".format(e)}
+        out.write(json.dumps(answer) + "\n")
+        out.flush()
+
+def serve_http(planner, port, host="127.0.0.1"):
+    """ Answers JSON requests POSTed to {host}:{port}, several at a time. GET returns the planner's stats. """
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, answer):
+            body = json.dumps(answer).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply(dict(planner.stats, cached=len(planner.cache)))
+
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+            except ValueError as e:
+                return self.reply({"error": "Bad JSON: {}".format(e)})
+            self.reply(planner.ask(request))
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    Server((host, port), Handler).serve_forever()
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--http", type=int, default=None, metavar="PORT", help="Serve over HTTP on this port instead of stdin.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--processes", type=int, default=None, help="Queries run at the same time, the number of CPUs by default.")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Answers kept for repeated queries.")
+    args = parser.parse_args()
+
+    planner = Planner(processes=args.processes, cache_size=args.cache_size)
+    try:
+        if args.http is not None:
+            serve_http(planner, args.http, host=args.host)
+        else:
+            serve_lines(planner)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        planner.close()
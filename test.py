@@ -1,5 +1,8 @@
 import unittest
+import os
 from bus import *
+import depdata as dd
+from depdata import recipe_matrix, recipe_graph, solve_demand, batch, science_packs
 
 class TestBus(unittest.TestCase):
     def test_direct_supplied_by(self):
@@ -34,33 +37,33 @@ class TestBus(unittest.TestCase):
     def test_possible_to_create(self):
         Bi = frozenset(["Grenade", "Piercing Rounds Magazine", "Gun Turret"])
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         out = possible_to_create(Bi)
         self.assertEqual(out, frozenset(["Military Science Pack"]))
 
         Bi = frozenset(["Advanced Circuit", "Electric Mining Drill", "Lubricant", "Electronic Circuit", "Engine Unit"])
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         out = possible_to_create(Bi)
         self.assertEqual(out, frozenset(["Science Pack 3", "Speed Module", "Electric Engine Unit"]))
 
         Bi = frozenset(["Battery", "Sulfuric Acid", "Advanced Circuit", "Electric Mining Drill", "Lubricant", "Electronic Circuit", "Engine Unit"])
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         out = possible_to_create(Bi)
         self.assertEqual(out, frozenset(["Processing Unit", "Science Pack 3", "Speed Module", "Electric Engine Unit"]))
 
     def test_creation_hypotheses(self):
         Bi = ["Grenade", "Piercing Rounds Magazine", "Gun Turret"]
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         out = creation_hypotheses(frozenset(Bi))
         h1 = frozenset(Bi+["Military Science Pack"])
         self.assertEqual(out, {h1})
 
         Bi = ["Advanced Circuit", "Electric Mining Drill", "Lubricant", "Electronic Circuit", "Engine Unit"]
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         out = creation_hypotheses(frozenset(Bi))
         h1 = frozenset(Bi+["Science Pack 3"])
         h2 = frozenset(Bi+["Electric Engine Unit"])
@@ -70,19 +73,19 @@ class TestBus(unittest.TestCase):
     def test_removal_hypothesis(self):
         Bi = ["Grenade", "Gun Turret"]
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         out = removal_hypotheses(frozenset(Bi))
         self.assertEqual(out, {frozenset(["Grenade"]), frozenset(["Gun Turret"])})
         
         Bi = ["Gun Turret"]
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         out = removal_hypotheses(frozenset(Bi))
         self.assertEqual(out, set())
         
         Bi = []
         for b in Bi:
-            assert b in D.nodes(), "Test Setup Error: {} not in D".format(b)
+            assert b in D, "Test Setup Error: {} not in D".format(b)
         self.assertEqual(out, set())
         
     def test_trim_path(self):
@@ -118,6 +121,542 @@ class TestBus(unittest.TestCase):
         
         out = trim_path(test_path, ["Sulfuric Acid"])
         self.assertListEqual(out, goal_path, "Failed to remove original unneccesary item Copper Plate")
-                     
+
+    def test_trim_paths(self):
+        from bench import synthetic_recipes
+        G, G0 = synthetic_recipes(items=30, depth=3, fan_in=3, goals=2, seed=3)
+        old = use_recipes(G)
+        try:
+            B0 = frozenset(find_roots(G))
+            GT = init_search(G0, B0, bitmask=True, reduce=False)
+            stats = GT.graph["stats"]
+            paths = [p for h, p in find_paths(GT, stop=lambda: stats.expansions >= 300)]
+            
+            # The sweep keeps exactly the items needed on a later bus
+            def reference(path):
+                later = path[1:-1] + [G0]
+                return [frozenset(x for x in b if any(needed_in(x, l) for l in later[i:])) for i, b in enumerate(path[:-1])] + [G0]
+            trimmed = [trim_path(p, G0) for p in paths]
+            self.assertListEqual(trimmed[:200], [reference(p) for p in paths[:200]])
+            
+            stats = SearchStats()
+            distinct = list(trim_paths(paths, G0, stats))
+            self.assertEqual(len(distinct), len(set(tuple(t) for t in trimmed)))
+            self.assertLess(len(distinct), len(paths))
+            self.assertEqual(stats.paths, len(paths))
+            self.assertEqual(stats.same_trims, len(paths) - len(distinct))
+        finally:
+            use_recipes(old)
+
+    def test_bus_index(self):
+        I = bus_index()
+        Bi = frozenset(["Advanced Circuit", "Electric Mining Drill", "Lubricant", "Electronic Circuit", "Engine Unit"])
+        self.assertEqual(I.decode(I.encode(Bi)), Bi)
+        self.assertEqual(width(I.encode(Bi)), len(Bi))
+        self.assertEqual(I.decode(I.possible_to_create(I.encode(Bi))), possible_to_create(Bi))
+        self.assertEqual(set(I.decode(h) for h in I.creation_hypotheses(I.encode(Bi))), creation_hypotheses(Bi))
+
+        ec = I.ids["Electronic Circuit"]
+        self.assertTrue(I.direct_supplied_by(ec, I.encode({"Iron Plate", "Copper Wire"})))
+        self.assertFalse(I.direct_supplied_by(ec, I.encode({"Iron Plate"})))
+        self.assertTrue(I.r_supplied_by(ec, I.encode({"Iron Ore", "Copper Plate"})))
+        self.assertFalse(I.r_supplied_by(ec, I.encode({"Iron Ore"})))
+
+        B0 = set(find_roots(D))
+        G0 = I.encode(["Science Pack 1", "Science Pack 2", "Science Pack 3", "Production Science Pack", "Military Science Pack", "High Tech Science Pack"])
+        self.assertTrue(I.valid(G0, I.encode(B0)))
+        self.assertFalse(I.valid(G0, I.encode(B0.difference({"Iron Ore"}))))
+        self.assertFalse(I.valid(G0, 0))
+        self.assertTrue(I.test_b(G0, G0 | I.encode(["Electronic Circuit"])))
+        self.assertFalse(I.test_b(G0, G0 & ~I.encode(["Science Pack 1"])))
+
+    def test_supplied(self):
+        I = BusIndex(D)
+        parent = I.encode({"Iron Ore", "Copper Ore"})
+        child = parent | I.encode({"Copper Plate"})
+        I.supplied(parent)
+        incremental = I.supplied(child, parent=parent)
+        self.assertEqual(incremental, BusIndex(D).supplied(child))
+        self.assertTrue({"Iron Plate", "Copper Wire", "Electronic Circuit", "Gun Turret"}.issubset(I.decode(incremental)))
+        self.assertFalse({"Iron Ore", "Plastic Bar", "Sulfur"}.intersection(I.decode(incremental)))
+
+    def test_distances(self):
+        I = bus_index()
+        GT = nx.DiGraph()
+        parent = frozenset(find_roots(D))
+        child = parent.union({"Iron Plate"})
+        table = I.distances(I.encode(parent))
+        incremental = I.distances(I.encode(child), I.encode(parent), table)
+        self.assertListEqual(incremental, I.distances(I.encode(child)))
+        for g in ["Iron Plate", "Iron Gear Wheel", "Electronic Circuit", "High Tech Science Pack"]:
+            self.assertEqual(table[I.ids[g]], dist(GT, g, parent))
+            self.assertEqual(incremental[I.ids[g]], dist(GT, g, child))
+        self.assertIsNone(I.distances(I.encode({"Iron Ore"}))[I.ids["Copper Plate"]])
+        
+        # A search only keeps the tables of the last few busses expanded, not one per open bus
+        GT = init_search(frozenset(science_packs), parent, bitmask=True)
+        list(find_paths(GT, stop=lambda: GT.graph["stats"].expansions >= 200))
+        self.assertFalse(any("distances" in GT.node[n] for n in GT))
+        self.assertEqual(len(GT.graph["tables"]), 64)
+        for mask, t in GT.graph["tables"].items():
+            self.assertListEqual(t, I.distances(mask))
+        
+        # Only starting busses are memoized, so a long search does not push its own out
+        class Counted(OrderedDict):
+            def __getitem__(self, k):
+                hits.append(k)
+                return OrderedDict.__getitem__(self, k)
+        hits, memo = [], I.distance_memo
+        self.assertLessEqual(len(memo), I.distance_memo_size)
+        self.assertIn(I.encode(parent), memo)
+        I.distance_memo = Counted(memo)
+        try:
+            solve(frozenset(science_packs), parent, bitmask=True, max_expansions=10)
+        finally:
+            I.distance_memo = memo
+        self.assertIn(I.encode(parent), hits)
+
+    def test_score_with_min_length(self):
+        B0 = frozenset(["Iron Ore", "Copper Ore", "Coal", "Stone Ore"])
+        G0 = frozenset(["Science Pack 1"])
+        GT = init_search(G0, B0, scoring=score_with_min_length)
+        for _ in range(30):
+            h = select_next(GT)
+            if h is None:
+                break
+            generate_and_validate(GT, G0, h)
+        for n in GT.nodes():
+            if "score" in GT.node[n]:
+                paths = nx.all_simple_paths(GT, source=B0, target=n) if n != B0 else [[B0]]
+                minimax = min(max(len(b) for b in path) for path in paths)
+                self.assertEqual(GT.node[n]["score"], GT.node[n]["distance"]*.5 + minimax*.5)
+
+    def test_main_budget(self):
+        B0 = frozenset(find_roots(D))
+        G0 = frozenset(science_packs)
+        stats = SearchStats()
+        path, width = main(G0, B0, verbose=False, max_expansions=300, stats=stats)
+        self.assertEqual(stats.expansions, 300)
+        self.assertEqual(width, rank(path)[0])
+
+    def test_parallel_main(self):
+        B0 = frozenset(find_roots(D))
+        G0 = frozenset(["Science Pack 1", "Science Pack 2", "Science Pack 3"])
+        path, width = main(G0, B0, verbose=False, time_limit=None)
+        
+        # Worker 0 runs main's search, so alone it finds the same path
+        self.assertEqual(parallel_main(G0, B0, weights=(None,), time_limit=None), (path, width))
+        par_path, par_width = parallel_main(G0, B0, weights=(None, .5), time_limit=None)
+        self.assertLessEqual(rank(par_path), rank(path))
+        self.assertEqual(par_width, rank(par_path)[0])
+        self.assertEqual(par_path[-1], G0)
+
+    def test_solve(self):
+        B0 = frozenset(find_roots(D))
+        G0 = frozenset(["Science Pack 1", "Science Pack 2"])
+        self.assertIsNone(solve(G0, B0, time_limit=0))
+
+        found = []
+        best = solve(G0, B0, max_expansions=5000, max_n=5, callback=lambda *s: found.append(s))
+        self.assertEqual(best, found[-1])
+        trim_p, max_width, length, mean_width = best
+        self.assertEqual(trim_p[-1], G0)
+        self.assertEqual((max_width, length, mean_width), rank(trim_p))
+        self.assertListEqual([s[1:] for s in found], sorted([s[1:] for s in found], reverse=True))
+
+    def test_solve_exact(self):
+        B0 = frozenset(find_roots(D))
+        G0 = frozenset(["Science Pack 1", "Science Pack 2"])
+        (trim_p, max_width, length, mean_width), certificate = solve_exact(G0, B0)
+        self.assertEqual((max_width, length), (8, 10))
+        self.assertAlmostEqual(mean_width, 4.6)
+        self.assertTrue(certificate["optimal"])
+        self.assertEqual(certificate["lower_bound"], (max_width, length, mean_width))
+        self.assertListEqual(trim_path(certificate["path"], G0), trim_p)
+        self.assertLessEqual((max_width, length, mean_width), solve(G0, B0, max_expansions=1000)[1:])
+        
+        # Out of time, the bound is still proven but not met
+        G0 = frozenset(["Science Pack 1", "Science Pack 2", "Science Pack 3", "Production Science Pack", "Military Science Pack", "High Tech Science Pack"])
+        best, certificate = solve_exact(G0, B0, time_limit=0)
+        self.assertFalse(certificate["optimal"])
+        self.assertEqual(certificate["lower_bound"][:2], best[1:3])
+        self.assertLess(certificate["lower_bound"][2], best[3])
+
+    def test_backward_search(self):
+        B0 = frozenset(find_roots(D))
+        G0 = frozenset(["High Tech Science Pack"])
+        expansions = {}
+        for kwargs in ({}, {"cone": True}, {"direction": "backward"}, {"direction": "both"}):
+            stats = SearchStats()
+            best = solve(G0, B0, max_expansions=1000, bitmask=True, stats=stats, **kwargs)
+            expansions[tuple(kwargs.items())] = stats.expansions
+            if kwargs:
+                self.assertEqual(best[1:3], (15, 13))
+        
+        # The whole cone is searched before the forward search runs out of budget
+        self.assertEqual(expansions[()], 1000)
+        self.assertLess(expansions[(("cone", True),)], 100)
+        
+        # Joined paths add one creatable item at a time and end with the whole cone
+        GT = init_search(G0, B0, direction="both")
+        cone = GT.graph["cone"]
+        for n, (h, path) in zip(range(20), meet_paths(GT)):
+            self.assertEqual(path[0], B0)
+            self.assertEqual(bus_index().encode(path[-1]), GT.graph["B0"] | cone)
+            for p0, p1 in zip(path, path[1:]):
+                added = p1 - p0
+                self.assertEqual(len(added), 1)
+                self.assertIn(next(iter(added)), possible_to_create(p0))
+            self.assertFalse(any(G0 <= p for p in path[:-1]))
+        self.assertGreater(GT.graph["stats"].regressions, 0)
+
+    def test_search_stats(self):
+        B0 = frozenset(find_roots(D))
+        G0 = frozenset(["Science Pack 1", "Science Pack 2"])
+        seen = []
+        stats = SearchStats(callback=lambda s: seen.append(s.expansions), every=10)
+        solve(G0, B0, max_expansions=100, stats=stats)
+        self.assertEqual(stats.expansions, 100)
+        self.assertListEqual(seen, list(range(10, 101, 10)))
+        self.assertEqual(stats.hypotheses, stats.valid_calls + stats.duplicates)
+        self.assertGreater(stats.duplicates, 0)
+        self.assertGreaterEqual(stats.score_calls, stats.valid_calls)
+        self.assertEqual(len(stats.frontier), 10)
+        self.assertEqual(set(stats.as_dict()["seconds"]), set(SearchStats.phases))
+        
+        # Only live entries of the open list that is being searched are counted
+        for direction in ("forward", "backward", "both"):
+            GT = init_search(G0, B0, bitmask=True, stats=SearchStats(every=1), direction=direction)
+            paths = find_paths(GT) if direction == "forward" else meet_paths(GT)
+            for n, _ in zip(range(30), paths):
+                pass
+            stats, GB = GT.graph["stats"], GT.graph.get("back")
+            self.assertEqual(len(stats.frontier), stats.expansions)
+            def live(G):
+                return len(set(h for s, _, h in G.graph["open"] if not G.node[h]["done"] and G.node[h]["score"] == s))
+            self.assertEqual(frontier_size(GT), (live(GT) if direction != "backward" else 0) + (live(GB) if GB is not None else 0))
+        
+        # Rescored busses and evictions keep the count
+        GT = init_search(G0, B0, bitmask=True, max_states=100)
+        for h, path in find_paths(GT):
+            break
+        h = next(h for s, _, h in GT.graph["open"] if not GT.node[h]["done"])
+        GT.node[h]["score"] -= 1
+        add_to_frontier(GT, h)
+        self.assertEqual(GT.graph["live"], live(GT))
+        while select_next(GT) is not None:
+            pass
+        self.assertEqual(GT.graph["live"], 0)
+
+    def test_bounded_search(self):
+        B0 = frozenset(find_roots(D))
+        G0 = frozenset(["Science Pack 1", "Science Pack 2", "Science Pack 3"])
+        GT = init_search(G0, B0, bitmask=True, max_states=100)
+        for h, path in find_paths(GT):
+            break
+        self.assertGreater(GT.graph["stats"].evicted, 0)
+        evict(GT)
+        
+        # Only first parents are kept, so the graph is a tree and every bus left is on the way to an open or goal bus
+        self.assertTrue(all(GT.in_degree(n) == 1 for n in GT if n != GT.graph["B0"]))
+        self.assertTrue(all(GT.out_degree(n) > 0 or not GT.node[n]["done"] or GT.node[n]["test"] for n in GT))
+        self.assertLess(len(GT), 100 + len(D))
+        self.assertTrue(all(g in path[-1] for g in G0))
+        self.assertTrue(all(len(p1 - p0) == 1 for p0, p1 in zip(path, path[1:])))
+
+    def test_frontier(self):
+        GT = nx.DiGraph()
+        init_frontier(GT)
+        for h, s, t in [("a", 3, False), ("b", 1, False), ("c", 2, False), ("g", 0, True)]:
+            GT.add_node(h, done=False, test=t, valid=True, score=s)
+            add_to_frontier(GT, h)
+        self.assertEqual(test(GT), "g")
+        self.assertIsNone(test(GT))
+
+        # Rescored and finished busses are skipped
+        GT.node["c"]["score"] = 0
+        add_to_frontier(GT, "c")
+        GT.node["b"]["done"] = True
+        self.assertEqual(select_next(GT), "c")
+        self.assertEqual(select_next(GT), "a")
+        self.assertIsNone(select_next(GT))
+
+    def test_synthetic_recipes(self):
+        from bench import synthetic_recipes
+        G, G0 = synthetic_recipes(items=60, depth=4, fan_in=3, goals=3, seed=1)
+        H, H0 = synthetic_recipes(items=60, depth=4, fan_in=3, goals=3, seed=1)
+        self.assertEqual(set(G.edges()), set(H.edges()))
+        self.assertEqual(G0, H0)
+        self.assertTrue(nx.is_directed_acyclic_graph(G))
+        self.assertEqual(nx.dag_longest_path_length(G), 4)
+        self.assertTrue(all(len(G.predecessors(n)) <= 3 for n in G.nodes()))
+        
+        # Each item draws its number of ingredients uniformly up to fan_in
+        G, G0 = synthetic_recipes(items=3000, depth=2, fan_in=3, seed=0)
+        counts = np.bincount([len(G.predecessors(n)) for n in G.nodes() if G.predecessors(n)])
+        self.assertTrue(all(abs(c/counts.sum() - 1/3.) < .05 for c in counts[1:]))
+
+        old = use_recipes(G)
+        try:
+            self.assertTrue(valid(G0, frozenset(find_roots(G))))
+        finally:
+            use_recipes(old)
+
+    def test_distinct_paths(self):
+        from bench import synthetic_recipes
+        G, G0 = synthetic_recipes(items=30, depth=3, fan_in=3, goals=2, seed=5)
+        old = use_recipes(G)
+        try:
+            B0 = frozenset(find_roots(G))
+            found = []
+            for reduce in (False, True):
+                GT = init_search(G0, B0, bitmask=True, reduce=reduce)
+                stats = GT.graph["stats"]
+                found.append([rank(trim_path(p, G0)) for h, p in find_paths(GT, stop=lambda: stats.expansions >= 300)])
+            
+            # Every rank is still found, from fewer paths
+            self.assertEqual(set(found[0]), set(found[1]))
+            self.assertLess(len(found[1]), len(found[0]))
+        finally:
+            use_recipes(old)
+
+    def test_planner(self):
+        import io, json, planner
+        P = planner.Planner(processes=2)
+        try:
+            q = {"id": 1, "goals": ["Science Pack 1"], "max_expansions": 200}
+            lines = [json.dumps([q, dict(q, id=2), {"id": 3, "goals": ["Nope"]}]), json.dumps(dict(q, id=4, exact=True)), json.dumps(q), "{", json.dumps(dict(q, id=5, direction="sideways")), json.dumps(q)]
+            out = io.StringIO()
+            planner.serve_lines(P, lines, out)
+            batch, exact, again, bad, sideways, last = [json.loads(l) for l in out.getvalue().splitlines()]
+            
+            # The same query is only run once, within a batch and after it
+            self.assertEqual([a["id"] for a in batch], [1, 2, 3])
+            self.assertEqual([a["cached"] for a in batch], [False, True, False])
+            self.assertEqual(batch[0]["path"], batch[1]["path"])
+            self.assertTrue(again["cached"])
+            self.assertEqual(again["path"], batch[0]["path"])
+            self.assertIn("Nope", batch[2]["error"])
+            self.assertIn("error", bad)
+            
+            # Bad options are answered with an error, without running them or stopping later lines
+            self.assertEqual(sideways["id"], 5)
+            self.assertIn("direction", sideways["error"])
+            self.assertEqual(last["path"], batch[0]["path"])
+            self.assertIn("error", planner.run(dict(q, start=["Iron Plate", "Copper Plate"], direction="sideways")))
+            
+            # The searched and the exact answers agree on this small goal
+            self.assertTrue(exact["optimal"])
+            self.assertEqual(exact["max_width"], batch[0]["max_width"])
+            self.assertEqual(exact["path"][-1], ["Science Pack 1"])
+            self.assertEqual(P.stats, {"queries": 7, "runs": 3, "hits": 3})
+        finally:
+            P.close()
+
+class TestDepdata(unittest.TestCase):
+    def test_solve_demand(self):
+        G = depdata(save=False)
+        for n in G.nodes():
+            customers = G.successors(n)
+            if customers:
+                expected = sum(G.edge[n][c]["QuantityPer"]*G.node[c]["QuantityNeeded"] for c in customers)
+                self.assertAlmostEqual(G.node[n]["QuantityNeeded"], expected)
+            if "FactoriesNeeded" in G.node[n]:
+                self.assertAlmostEqual(G.node[n]["FactoriesNeeded"], G.node[n]["QuantityNeeded"]/G.node[n]["QuantityPer"])
+
+        # Two goals in one solve
+        items = ["Iron Ore", "Iron Plate", "Iron Gear Wheel", "Pipe"]
+        dependencies = pd.DataFrame({"Parent": ["Iron Plate", "Iron Gear Wheel", "Pipe"],
+                                     "Child": ["Iron Ore", "Iron Plate", "Iron Plate"],
+                                     "Amount": [1., 2., 1.]})
+        A = recipe_matrix(items, dependencies)
+        self.assertEqual(dd.recipe_depth(A), 3)
+        x = solve_demand(A, [[0, 0], [0, 0], [1, 0], [0, 3]])
+        self.assertListEqual(x.tolist(), [[2, 3], [2, 3], [1, 0], [0, 3]])
+
+    def test_solve_rates(self):
+        import tempfile, shutil, json
+        # Oil processing gives light oil and petroleum gas besides heavy oil, and cracking turns heavy into light into gas
+        oil = [{"name": "Heavy Oil", "time": 5, "ingredients": {"Crude Oil": 4}, "byproducts": {"Light Oil": 1.8, "Petroleum Gas": 2.2}},
+               {"name": "Light Oil", "time": 3, "ingredients": {"Heavy Oil": 4/3., "Water": 1}},
+               {"name": "Petroleum Gas", "time": 3, "ingredients": [["Light Oil", 1.5], ["Water", 1]]},
+               {"name": "Uranium 235", "time": 50, "ingredients": {"Uranium 235": 40/41., "Uranium 238": 5/41.}}]
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "oil.json")
+            with open(path, "w") as f:
+                json.dump(oil, f)
+            r = dd.load_recipes(path)
+        finally:
+            shutil.rmtree(tmp)
+        R = dd.Recipes(r["items"], r["time"], r["output"], r["child"], r["parent"], r["amount"], (r["by_item"], r["by_maker"], r["by_amount"]))
+        self.assertEqual(R.to_networkx().node["Heavy Oil"]["Byproducts"], {"Light Oil": 1.8, "Petroleum Gas": 2.2})
+        self.assertRaises(ValueError, R.order)
+        A, P = R.matrix(), R.byproduct_matrix()
+        
+        # Each recipe makes up exactly what the byproducts fall short of
+        d = np.zeros((len(R), 3))
+        d[R.ids["Petroleum Gas"], 0] = 100
+        d[R.ids["Heavy Oil"], 1] = 10
+        d[R.ids["Uranium 235"], 2] = 1
+        x = solve_demand(A, d, P)
+        np.testing.assert_allclose(x, np.maximum(0, A.dot(x) - P.dot(x) + d), atol=1e-9)
+        self.assertAlmostEqual(x[R.ids["Heavy Oil"], 0], 200/7.8)
+        self.assertEqual(x[R.ids["Light Oil"], 1], 0)
+        self.assertAlmostEqual(x[R.ids["Crude Oil"], 1], 40)
+        self.assertAlmostEqual(x[R.ids["Uranium 235"], 2], 41)
+        self.assertAlmostEqual(x[R.ids["Uranium 238"], 2], 5)
+        
+        # A loop without byproducts is solved as one linear system, and one consuming more than it makes has no rates
+        np.testing.assert_allclose(solve_demand(A, d[:, 2]), x[:, 2])
+        G = nx.DiGraph()
+        G.add_edge("X", "X", QuantityPer=2.)
+        G.add_edge("Ore", "X", QuantityPer=1.)
+        L = dd.Recipes.from_graph(G)
+        self.assertIsNone(dd.recipe_depth(A))
+        self.assertIsNone(dd.recipe_depth(L.matrix()))
+        self.assertRaises(ValueError, solve_demand, L.matrix(), np.eye(len(L))[L.ids["X"]])
+
+    def test_batch(self):
+        items, factories = batch([1, 16])
+        self.assertEqual(factories.shape, (2, len(items)))
+        for k, tc in enumerate([1, 16]):
+            G = depdata(tc, save=False)
+            for i, n in enumerate(items):
+                if "FactoriesNeeded" in G.node[n]:
+                    self.assertAlmostEqual(factories[k, i], G.node[n]["FactoriesNeeded"])
+                else:
+                    self.assertTrue(np.isnan(factories[k, i]))
+
+        # Demand scales linearly with the goals
+        goals = np.ones((2, len(science_packs)))
+        goals[1] *= 3
+        items, factories = batch([1, 1], goals)
+        np.testing.assert_allclose(factories[1], 3*factories[0])
+
+    def test_recipe_graph(self):
+        G, R = depdata(save=False), recipe_graph()
+        self.assertEqual(set(G.nodes()), set(R.nodes()))
+        self.assertEqual(set(G.edges()), set(R.edges()))
+        for n1, n2 in R.edges():
+            self.assertEqual(R.edge[n1][n2]["QuantityPer"], G.edge[n1][n2]["QuantityPer"])
+        for n in R.nodes():
+            for k in ("Time", "QuantityOut"):
+                self.assertEqual(R.node[n].get(k), G.node[n].get(k))
+
+    def test_recipes(self):
+        R, G = dd.recipes(), recipe_graph()
+        self.assertEqual(len(R), len(G))
+        for n in G.nodes():
+            self.assertEqual(sorted(R.predecessors(n)), sorted(G.predecessors(n)))
+            self.assertEqual(sorted(R.successors(n)), sorted(G.successors(n)))
+        self.assertEqual(sorted(R.roots()), sorted(n for n in G if not G.predecessors(n)))
+        dense = lambda A: A.toarray() if hasattr(A, "toarray") else A
+        ids = [R.ids[n] for n in G.nodes()]
+        np.testing.assert_array_equal(dense(dd.Recipes.from_graph(G).matrix()), dense(dd.recipe_model()[1])[np.ix_(ids, ids)])
+        self.assertRaises(ValueError, R.pred.__setitem__, 0, 1)
+        
+        # Ingredients come before their products, and a cycle has no order
+        position = {R.items[i]: k for k, i in enumerate(R.order())}
+        self.assertTrue(all(position[c] < position[p] for c, p in G.edges()))
+        G.add_edge("Science Pack 1", "Iron Plate", QuantityPer=1.)
+        self.assertRaises(ValueError, dd.Recipes.from_graph(G).order)
+
+    def test_compile_cache(self):
+        import tempfile, shutil
+        old_cache_dir, old_compiled = dd.cache_dir, dd._compiled
+        dd.cache_dir, dd._compiled = tempfile.mkdtemp(), {}
+        try:
+            compiled = dd.compile_recipes()
+            self.assertEqual(len(os.listdir(dd.cache_dir)), 1)
+            dd._compiled = {}
+            cached = dd.compile_recipes()
+            self.assertListEqual(cached["items"], compiled["items"])
+            np.testing.assert_array_equal(cached["amount"], compiled["amount"])
+        finally:
+            shutil.rmtree(dd.cache_dir)
+            dd.cache_dir, dd._compiled = old_cache_dir, old_compiled
+
+    def test_loaders(self):
+        import tempfile, shutil, json
+        def triples(r):
+            return sorted((r["items"][c], r["items"][p], a) for c, p, a in zip(r["child"], r["parent"], r["amount"]))
+        def recipes(r):
+            return {n: (t, o) for n, t, o in zip(r["items"], r["time"], r["output"]) if not np.isnan(t)}
+
+        wide = dd.load_wide(dd.csv_path)
+        for chunksize in (3, 7):
+            self.assertEqual(triples(dd.load_wide(dd.csv_path, chunksize=chunksize)), triples(wide))
+
+        # Write the same recipes in the long and JSON lines layouts
+        data = dd.load_data()
+        dependencies = dd.relational(data).merge(data[["Parent", "Time", "Output"]], on="Parent")
+        tmp = tempfile.mkdtemp()
+        try:
+            long_path, json_path = os.path.join(tmp, "recipes.csv"), os.path.join(tmp, "recipes.jsonl")
+            dependencies[["Parent", "Child", "Amount", "Time", "Output"]].to_csv(long_path, index=False)
+            with open(json_path, "w") as f:
+                for _, row in data.iterrows():
+                    ingredients = dependencies[dependencies["Parent"] == row["Parent"]]
+                    f.write(json.dumps({"name": row["Parent"], "time": row["Time"], "output": int(row["Output"]),
+                                        "ingredients": [[c, a] for c, a in zip(ingredients["Child"], ingredients["Amount"])]})+"\n")
+
+            for path in (long_path, json_path):
+                for chunksize in (1, 5, 100000):
+                    out = dd.load_recipes(path, chunksize)
+                    self.assertEqual(triples(out), triples(wide))
+                    self.assertEqual(recipes(out), recipes(wide))
+                    self.assertEqual(set(out["items"]), set(wide["items"]))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_model(self):
+        def needed(G):
+            return {n: G.node[n]["QuantityNeeded"] for n in G.nodes()}
+        G = depdata(4, save=False)
+        m = dd.Model(4)
+        for n in G.nodes():
+            for k in ("QuantityNeeded", "FactoriesNeeded"):
+                if k in G.node[n]:
+                    self.assertAlmostEqual(m.G.node[n][k], G.node[n][k])
+        
+        # Only the ingredients of the edited recipe are recomputed, and agree with a full solve
+        self.assertEqual(m.set_recipe("Iron Gear Wheel", {"Iron Plate": 4}), {"Iron Plate", "Iron Ore"})
+        self.assertEqual(m.set_recipe("Iron Gear Wheel", time=1), {"Iron Gear Wheel"})
+        self.assertAlmostEqual(m.G.node["Iron Gear Wheel"]["FactoriesNeeded"], G.node["Iron Gear Wheel"]["FactoriesNeeded"]*2)
+        self.assertEqual(m.set_recipe("Pipe", {"Iron Plate": 1, "Copper Plate": 1}), {"Iron Plate", "Iron Ore", "Copper Plate", "Copper Ore"})
+        m.set_goal("Pipe", 3)
+        full = dd.Model(4, goals=m.goals, G=m.G.copy())
+        for n, x in needed(full.G).items():
+            self.assertAlmostEqual(m.G.node[n]["QuantityNeeded"], x)
+        self.assertGreater(m.G.node["Iron Plate"]["QuantityNeeded"], G.node["Iron Plate"]["QuantityNeeded"])
+        self.assertEqual(m.G.edge["Iron Plate"]["Iron Gear Wheel"]["label"], "QuantityPer: 4\n")
+        self.assertRaises(ValueError, m.set_recipe, "Iron Plate", {"Pipe": 1})
+        goals = dict(m.goals)
+        self.assertRaises(ValueError, m.set_goal, "Nope", 1)
+        self.assertEqual(m.goals, goals)
+        
+    def test_save_graph(self):
+        import tempfile, shutil
+        G = depdata(save=False)
+        text = dd.to_dot(G)
+        self.assertEqual(text.count(" -> "), G.number_of_edges())
+        self.assertIn('"Iron Plate" [', text)
+        self.assertIn("rankdir", text)
+        self.assertTrue(G.node["Iron Plate"]["label"].startswith("Iron Plate"))
+        
+        tmp = tempfile.mkdtemp()
+        try:
+            self.assertEqual(dd.save_graph(G, "g", tmp, formats=()), [])
+            with open(os.path.join(tmp, "g", "g.dot")) as f:
+                self.assertEqual(f.read(), text)
+            
+            # An unchanged graph whose drawing exists is not rendered again
+            open(os.path.join(tmp, "g", "g.png"), "w").close()
+            self.assertEqual(dd.save_graphs([(G, "g")], tmp, formats=("png",)), [[]])
+            self.assertEqual(dd.save_graphs(((G, n) for n in ["g"]), tmp, formats=("png",)), [[]])
+        finally:
+            shutil.rmtree(tmp)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file